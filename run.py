@@ -6,18 +6,24 @@ import os
 import sys
 from dataclasses import dataclass, field
 from typing import Callable, Dict, Optional
+import time
 import torch
+import torch.nn as nn
 
 import numpy as np
 
 import transformers
-from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, EvalPrediction
+from transformers import AutoConfig, AutoModelForSequenceClassification, EvalPrediction
 from transformers import GlueDataTrainingArguments as DataTrainingArguments
 from transformers import HfArgumentParser, TrainingArguments, set_seed
 
-from src.dataset import FewShotDataset
-from src.models import BertForPromptFinetuning, RobertaForPromptFinetuning, resize_token_type_embeddings
+from src.dataset import DynamicPaddingCollator
+from src.token_cache import get_token_cache
+from src.device import configure_cpu_threads
+from src.sweep import TrialResources
+from src.models import BertForPromptFinetuning, RobertaForPromptFinetuning, resize_token_type_embeddings, attach_label_head
 from src.trainer import Trainer
+from src.replicas import train_replicas
 from src.processors import processors_mapping, num_labels_mapping, output_modes_mapping, compute_metrics_mapping, bound_mapping
 
 from filelock import FileLock
@@ -62,6 +68,17 @@ class ModelArguments:
         metadata={"help": "Whether to reinitialize the token type embeddings (only for BERT)."}
     )
 
+    # Inference
+    mask_only_last_layer: bool = field(
+        default=False,
+        metadata={"help": "In evaluation, compute the last layer of prompt models at the mask position only"}
+    )
+
+    quantize_int8: bool = field(
+        default=False,
+        metadata={"help": "Inference only (CPU): also evaluate with dynamic int8 quantization, and report the deltas against fp32"}
+    )
+
 @dataclass
 class DynamicDataTrainingArguments(DataTrainingArguments):
     """
@@ -155,6 +172,11 @@ class DynamicDataTrainingArguments(DataTrainingArguments):
         metadata={"help": "Model name for demonstration filter embeddings. Will load embeddings based on the model name."}
     )
 
+    demo_per_label: int = field(
+        default=1,
+        metadata={"help": "Number of demonstrations per label (the template needs sentence slots for all of them)"}
+    )
+
     debug_mode: bool = field(
         default=False,
         metadata={"help": "Debug mode"}
@@ -202,6 +224,37 @@ class DynamicDataTrainingArguments(DataTrainingArguments):
         metadata={"help": "When exceeding the maximum length, truncate the head instead of the tail."}
     )
 
+    dynamic_padding: bool = field(
+        default=False,
+        metadata={"help": "Do not pad features to max_seq_length; pad each batch to its longest sequence instead"}
+    )
+
+    lazy_features: bool = field(
+        default=False,
+        metadata={"help": "Build dev/test features on demand (in chunks, prefetched in the background) instead of up front"}
+    )
+
+    featurize_workers: int = field(
+        default=0,
+        metadata={"help": "Number of processes to build dev/test features with (0 or 1: in the main process)"}
+    )
+
+    feature_cache: bool = field(
+        default=True,
+        metadata={"help": "Cache dev/test features on disk (keyed by a hash of the featurization arguments)"}
+    )
+
+    # Token id cache (shared by all the datasets in the process)
+    token_cache_size: int = field(
+        default=1000000,
+        metadata={"help": "Maximum number of (sentence, variant) entries in the token id cache"}
+    )
+
+    token_cache_mb: int = field(
+        default=1024,
+        metadata={"help": "Maximum (approximate) memory of the token id cache in MB"}
+    )
+
     # Do not set up the following fields. They are set up automatically.
     prompt: bool = field(
         default=False,
@@ -242,49 +295,90 @@ class DynamicTrainingArguments(TrainingArguments):
         metadata={"help": "Fix bottom-n layers when optimizing"}
     )
 
+    cache_frozen_layers: bool = field(
+        default=False,
+        metadata={"help": "With fix_layers, cache the frozen layer outputs (computed without dropout) of each training input"}
+    )
+
     # Training
     save_at_last: bool = field(
         default=False,
         metadata={"help": "Instead of saving the best (dev performance) checkpoint, save the last checkpoint"}
     )
 
-    # Turn off train/test
-    no_train: bool = field(
+    early_stopping_patience: int = field(
+        default=0,
+        metadata={"help": "Stop training after this many evaluations without improvement of the dev objective (0: no early stopping)"}
+    )
+
+    early_stopping_min_delta: float = field(
+        default=0.0,
+        metadata={"help": "Minimum increase of the dev objective that counts as an improvement for early stopping"}
+    )
+
+    time_budget: float = field(
+        default=0,
+        metadata={"help": "Stop training after this many seconds (0: no limit)"}
+    )
+
+    in_memory_checkpoint: bool = field(
         default=False,
-        metadata={"help": "No training"}
+        metadata={"help": "Keep the best checkpoint as an in-memory (CPU) snapshot and restore it in-process, instead of saving and reloading it"}
     )
-    no_predict: bool = field(
+
+    persist_checkpoint: bool = field(
         default=False,
-        metadata={"help": "No test"}
+        metadata={"help": "With in_memory_checkpoint, also write the best checkpoint to output_dir (in a background thread)"}
     )
 
+    # Profiling
+    profile: bool = field(
+        default=False,
+        metadata={"help": "Time the phases of the training steps (data, collate, forward, backward, optimizer, eval, save) and add them to the log"}
+    )
 
-def main():
-    parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, DynamicTrainingArguments))
+    profile_trace: str = field(
+        default=None,
+        metadata={"help": "Also write the timed phases to this file as a Chrome trace (chrome://tracing, Perfetto); implies --profile"}
+    )
 
-    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
-        # If we pass only one argument to the script and it's the path to a json file,
-        # let's parse it to get our arguments.
-        model_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
-    else:
-        model_args, data_args, training_args = parser.parse_args_into_dataclasses()
+    # Evaluation
+    eval_length_bucketing: bool = field(
+        default=False,
+        metadata={"help": "Batch dev/test examples by length (use with --dynamic_padding)"}
+    )
 
-    if 'prompt' in model_args.few_shot_type:
-        data_args.prompt = True
+    # CPU threads
+    intra_op_threads: int = field(
+        default=0,
+        metadata={"help": "Number of threads inside each op (0: PyTorch default, or one per core of cpu_affinity)"}
+    )
 
-    if training_args.no_train:
-        training_args.do_train = False
-    if training_args.no_predict:
-        training_args.do_predict = False
+    inter_op_threads: int = field(
+        default=0,
+        metadata={"help": "Number of threads running independent ops (0: PyTorch default)"}
+    )
 
-    # Setup logging
-    logging.basicConfig(
-        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
-        datefmt="%m/%d/%Y %H:%M:%S",
-        level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
+    cpu_affinity: str = field(
+        default=None,
+        metadata={"help": "Pin the process to these CPU cores, e.g., 0-7,16-23"}
     )
 
-    # Load prompt/template/mapping file
+    # Turn off train/test
+    no_train: bool = field(
+        default=False,
+        metadata={"help": "No training"}
+    )
+    no_predict: bool = field(
+        default=False,
+        metadata={"help": "No test"}
+    )
+
+
+def load_prompt(data_args):
+    """
+    Load the prompt/template/mapping files (prompt_path, template_path, mapping_path) into data_args.
+    """
     if data_args.prompt:
         if data_args.prompt_path is not None:
             assert data_args.prompt_id is not None
@@ -328,36 +422,11 @@ def main():
                 data_args.mapping = mapping_list[data_args.mapping_id]
                 logger.info("Specify using the %d-th mapping: %s" % (data_args.mapping_id, data_args.mapping))
 
-    # Check save path
-    if (
-        os.path.exists(training_args.output_dir)
-        and os.listdir(training_args.output_dir)
-        and training_args.do_train
-        and not training_args.overwrite_output_dir
-    ):
-        raise ValueError(f"Output directory ({training_args.output_dir}) already exists.")
 
-    logger.warning(
-        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
-        training_args.local_rank,
-        training_args.device,
-        training_args.n_gpu,
-        bool(training_args.local_rank != -1),
-        training_args.fp16,
-    )
-    logger.info("Training/evaluation parameters %s", training_args)
-
-    # Set seed
-    set_seed(training_args.seed)
-
-    try:
-        num_labels = num_labels_mapping[data_args.task_name]
-        output_mode = output_modes_mapping[data_args.task_name]
-        logger.info("Task name: {}, number of labels: {}, output mode: {}".format(data_args.task_name, num_labels, output_mode))
-    except KeyError:
-        raise ValueError("Task not found: %s" % (data_args.task_name))
-
-    # Automatically generate template for using demonstrations
+def auto_demo_template(model_args, data_args, num_labels):
+    """
+    Automatically generate the template for using demonstrations (auto_demo).
+    """
     if data_args.auto_demo and model_args.few_shot_type == 'prompt-demo':
         # GPT-3's in-context learning
         if data_args.gpt3_in_context_head or data_args.gpt3_in_context_tail: 
@@ -424,6 +493,136 @@ def main():
                 logger.info("| {} => {}".format(data_args.template, new_template))
                 data_args.template = new_template
 
+
+def main():
+    parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, DynamicTrainingArguments))
+
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        # If we pass only one argument to the script and it's the path to a json file,
+        # let's parse it to get our arguments.
+        model_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, data_args, training_args = parser.parse_args_into_dataclasses()
+
+    # Once per process (the inter-op threads cannot be set again), so not in `run`, which may run many trials
+    configure_cpu_threads(training_args.intra_op_threads, training_args.inter_op_threads, training_args.cpu_affinity)
+
+    return run(model_args, data_args, training_args)
+
+
+@dataclass
+class Trial:
+    """
+    A trial set up by `setup_trial`: its arguments, data and trainer.
+    """
+    model_args: ModelArguments
+    data_args: DynamicDataTrainingArguments
+    training_args: DynamicTrainingArguments
+    resources: TrialResources
+    model_fn: Callable
+    tokenizer: object
+    train_dataset: object
+    eval_dataset: object
+    test_dataset: object
+    trainer: Trainer
+    build_compute_metrics_fn: Callable
+
+
+def run(model_args, data_args, training_args, resources=None, log_file='log', extra_result=None):
+    """
+    Train and evaluate one trial, and append its results (and extra_result) to log_file. With `resources`
+    (`TrialResources`), the tokenizer, the pretrained weights and the datasets are shared with the other trials of the
+    process (tools/sweep.py).
+    """
+    trial = setup_trial(model_args, data_args, training_args, resources=resources)
+
+    # Training
+    if training_args.do_train:
+        trial.trainer.train(model_path=model_args.model_name_or_path if os.path.isdir(model_args.model_name_or_path) else None)
+
+    return finish_trial(trial, log_file=log_file, extra_result=extra_result)
+
+
+def run_replicas(arguments, resources=None, log_files=None, extra_results=None):
+    """
+    Run trials that only differ by their seed and data split (`arguments`: their (model_args, data_args,
+    training_args)) as replicas trained together (see `train_replicas`), then evaluate each of them as `run` does.
+    """
+    if resources is None:
+        resources = TrialResources(share=True)
+    log_files = log_files if log_files is not None else ['log'] * len(arguments)
+    extra_results = extra_results if extra_results is not None else [None] * len(arguments)
+
+    output_dirs = [training_args.output_dir for _, _, training_args in arguments]
+    if len(set(output_dirs)) < len(output_dirs):
+        raise ValueError("Replicas need different output_dir")
+
+    trials = [setup_trial(model_args, data_args, training_args, resources=resources) for model_args, data_args, training_args in arguments]
+    if any(trial.training_args.do_train for trial in trials):
+        if not all(trial.training_args.do_train for trial in trials):
+            raise ValueError("Either all the replicas or none are trained")
+        train_replicas([trial.trainer for trial in trials])
+
+    return [finish_trial(trial, log_file=log_file, extra_result=extra_result) for trial, log_file, extra_result in zip(trials, log_files, extra_results)]
+
+
+def setup_trial(model_args, data_args, training_args, resources=None):
+    """
+    Everything before training: the config, tokenizer, datasets, model and trainer of a trial.
+    """
+    if resources is None:
+        resources = TrialResources(share=False)
+
+    if 'prompt' in model_args.few_shot_type:
+        data_args.prompt = True
+
+    if training_args.no_train:
+        training_args.do_train = False
+    if training_args.no_predict:
+        training_args.do_predict = False
+
+    # Setup logging
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
+    )
+
+    # Load prompt/template/mapping file
+    load_prompt(data_args)
+
+    # Check save path
+    if (
+        os.path.exists(training_args.output_dir)
+        and os.listdir(training_args.output_dir)
+        and training_args.do_train
+        and not training_args.overwrite_output_dir
+    ):
+        raise ValueError(f"Output directory ({training_args.output_dir}) already exists.")
+
+    logger.warning(
+        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
+        training_args.local_rank,
+        training_args.device,
+        training_args.n_gpu,
+        bool(training_args.local_rank != -1),
+        training_args.fp16,
+    )
+    logger.info("Training/evaluation parameters %s", training_args)
+
+    # Set seed
+    set_seed(training_args.seed)
+
+    try:
+        num_labels = num_labels_mapping[data_args.task_name]
+        output_mode = output_modes_mapping[data_args.task_name]
+        logger.info("Task name: {}, number of labels: {}, output mode: {}".format(data_args.task_name, num_labels, output_mode))
+    except KeyError:
+        raise ValueError("Task not found: %s" % (data_args.task_name))
+
+    # Automatically generate template for using demonstrations
+    auto_demo_template(model_args, data_args, num_labels)
+
     # Create config
     config = AutoConfig.from_pretrained(
         model_args.config_name if model_args.config_name else model_args.model_name_or_path,
@@ -446,35 +645,31 @@ def main():
     special_tokens = []
 
     # Create tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(
+    tokenizer = resources.tokenizer(
         model_args.tokenizer_name if model_args.tokenizer_name else model_args.model_name_or_path,
         additional_special_tokens=special_tokens,
         cache_dir=model_args.cache_dir,
     )
+    get_token_cache(tokenizer).resize(max_entries=data_args.token_cache_size, max_bytes=data_args.token_cache_mb << 20)
 
     # Get our special datasets.
     train_dataset = (
-        FewShotDataset(data_args, tokenizer=tokenizer, mode="train", use_demo=("demo" in model_args.few_shot_type))
+        resources.dataset(data_args, tokenizer, "train", use_demo=("demo" in model_args.few_shot_type), seed=training_args.seed)
     )
     eval_dataset = (
-        FewShotDataset(data_args, tokenizer=tokenizer, mode="dev", use_demo=("demo" in model_args.few_shot_type))
+        resources.dataset(data_args, tokenizer, "dev", use_demo=("demo" in model_args.few_shot_type), seed=training_args.seed)
         if training_args.do_eval
         else None
     )
     test_dataset = (
-        FewShotDataset(data_args, tokenizer=tokenizer, mode="test", use_demo=("demo" in model_args.few_shot_type))
+        resources.dataset(data_args, tokenizer, "test", use_demo=("demo" in model_args.few_shot_type), seed=training_args.seed)
         if training_args.do_predict
         else None
     )
 
     set_seed(training_args.seed)
 
-    model = model_fn.from_pretrained(
-        model_args.model_name_or_path,
-        from_tf=bool(".ckpt" in model_args.model_name_or_path),
-        config=config,
-        cache_dir=model_args.cache_dir,
-    )
+    model = resources.pretrained_model(model_fn, model_args.model_name_or_path, config, cache_dir=model_args.cache_dir)
 
     # For BERT, increase the size of the segment (token type) embeddings
     if config.model_type == 'bert':
@@ -483,7 +678,7 @@ def main():
 
     # Pass dataset and argument information to the model
     if data_args.prompt:
-        model.label_word_list = torch.tensor(train_dataset.label_word_list).long().cuda()
+        model.label_word_list = torch.tensor(train_dataset.label_word_list).long().to(training_args.device)
     if output_modes_mapping[data_args.task_name] == 'regression':
         # lower / upper bounds
         model.lb, model.ub = bound_mapping[data_args.task_name]
@@ -523,27 +718,60 @@ def main():
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
+        data_collator=DynamicPaddingCollator(tokenizer.pad_token_id),
         compute_metrics=build_compute_metrics_fn(data_args.task_name)
     )
 
-    # Training
+    return Trial(
+        model_args=model_args,
+        data_args=data_args,
+        training_args=training_args,
+        resources=resources,
+        model_fn=model_fn,
+        tokenizer=tokenizer,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        test_dataset=test_dataset,
+        trainer=trainer,
+        build_compute_metrics_fn=build_compute_metrics_fn,
+    )
+
+
+def finish_trial(trial, log_file='log', extra_result=None):
+    """
+    Everything after training: reload (or restore) the best model, evaluate it and append the results to log_file.
+    """
+    model_args, data_args, training_args = trial.model_args, trial.data_args, trial.training_args
+    resources, model_fn, tokenizer, trainer = trial.resources, trial.model_fn, trial.tokenizer, trial.trainer
+    train_dataset, eval_dataset, test_dataset = trial.train_dataset, trial.eval_dataset, trial.test_dataset
+    build_compute_metrics_fn = trial.build_compute_metrics_fn
+    model = trainer.model
+
     if training_args.do_train:
-        trainer.train(model_path=model_args.model_name_or_path if os.path.isdir(model_args.model_name_or_path) else None)
         # Use the early stop, so do not save the model in the end (unless specify save_at_last)
         if training_args.save_at_last:
+            trainer.finish_checkpoint()
             trainer.save_model(training_args.output_dir)
  
-        if trainer.is_world_master():
+        persist = not training_args.in_memory_checkpoint or training_args.persist_checkpoint or training_args.save_at_last
+        if trainer.is_world_master() and persist:
+            os.makedirs(training_args.output_dir, exist_ok=True)
             tokenizer.save_pretrained(training_args.output_dir)
             torch.save(model_args, os.path.join(training_args.output_dir, "model_args.bin"))
             torch.save(data_args, os.path.join(training_args.output_dir, "data_args.bin"))
         
-        # Reload the best checkpoint (for eval)
-        model = model_fn.from_pretrained(training_args.output_dir)
-        model = model.to(training_args.device)
-        trainer.model = model
+        if training_args.in_memory_checkpoint:
+            # Restore the best snapshot in-process (the last model is kept with save_at_last)
+            if not training_args.save_at_last:
+                trainer.restore_best()
+            model = trainer.model
+        else:
+            # Reload the best checkpoint (for eval)
+            model = model_fn.from_pretrained(training_args.output_dir)
+            model = model.to(training_args.device)
+            trainer.model = model
         if data_args.prompt:
-            model.label_word_list = torch.tensor(train_dataset.label_word_list).long().cuda()
+            model.label_word_list = torch.tensor(train_dataset.label_word_list).long().to(training_args.device)
         if output_modes_mapping[data_args.task_name] == 'regression':
             # lower / upper bounds
             model.lb, model.ub = bound_mapping[data_args.task_name]
@@ -551,10 +779,54 @@ def main():
         model.data_args = data_args
         model.tokenizer = tokenizer
 
+    # Dynamic int8 quantization (inference only): the datasets are evaluated with both the fp32 and the int8 model
+    if model_args.quantize_int8:
+        if training_args.do_train or training_args.device.type != "cpu":
+            raise ValueError("--quantize_int8 is for CPU inference only, use it with --no_train and --no_cuda")
+        fp32_model = trainer.model
+        if data_args.prompt:
+            attach_label_head(fp32_model)
+        int8_model = torch.quantization.quantize_dynamic(fp32_model, {nn.Linear}, dtype=torch.qint8)
+
+    def timed_evaluate(model, dataset):
+        """
+        Evaluate model on dataset, and time a second pass: the first (untimed) pass pays for the warm-up (lazy
+        features, memory allocation, ...), which would otherwise favor the model timed second.
+        """
+        trainer.model = model
+        trainer.evaluate(eval_dataset=dataset)
+        start = time.time()
+        output = trainer.evaluate(eval_dataset=dataset)
+        return output, len(dataset) / (time.time() - start)
+
+    def evaluate(dataset, prefix):
+        """
+        Evaluate the model on dataset. With quantize_int8, return the output of the int8 model, and add its metric
+        deltas and the throughputs (examples / s) of both models to final_result (keys starting with prefix).
+        """
+        if not model_args.quantize_int8:
+            return trainer.evaluate(eval_dataset=dataset)
+
+        fp32_output, fp32_speed = timed_evaluate(fp32_model, dataset)
+        output, int8_speed = timed_evaluate(int8_model, dataset)
+        report = {prefix + 'fp32_examples_per_sec': fp32_speed, prefix + 'int8_examples_per_sec': int8_speed}
+        for key, value in fp32_output.metrics.items():
+            report[prefix + 'fp32_' + key] = value
+            if key in output.metrics:
+                report[prefix + 'int8_delta_' + key] = output.metrics[key] - value
+        logger.info("***** Quantization ({}) *****".format(prefix[:-1]))
+        for key, value in report.items():
+            logger.info("  %s = %s", key, value)
+        final_result.update(report)
+        return output
+
     # Evaluation
     final_result = {
         'time': str(datetime.today()),
     }
+    if training_args.do_train:
+        # Stopping step and the compute saved by early stopping
+        final_result.update(trainer.train_summary)
 
     eval_results = {}
     if training_args.do_eval:
@@ -564,7 +836,7 @@ def main():
 
         for eval_dataset in eval_datasets:
             trainer.compute_metrics = build_compute_metrics_fn(eval_dataset.args.task_name)
-            output = trainer.evaluate(eval_dataset=eval_dataset)
+            output = evaluate(eval_dataset, eval_dataset.args.task_name + '_dev_')
             eval_result = output.metrics 
 
             output_eval_file = os.path.join(
@@ -586,12 +858,12 @@ def main():
         if data_args.task_name == "mnli":
             mnli_mm_data_args = dataclasses.replace(data_args, task_name="mnli-mm")
             test_datasets.append(
-                FewShotDataset(mnli_mm_data_args, tokenizer=tokenizer, mode="test", use_demo=('demo' in model_args.few_shot_type))
+                resources.dataset(mnli_mm_data_args, tokenizer, "test", use_demo=('demo' in model_args.few_shot_type), seed=training_args.seed)
             )
 
         for test_dataset in test_datasets:
             trainer.compute_metrics = build_compute_metrics_fn(test_dataset.args.task_name)
-            output = trainer.evaluate(eval_dataset=test_dataset)
+            output = evaluate(test_dataset, test_dataset.args.task_name + '_test_')
             test_result = output.metrics
 
             output_test_file = os.path.join(
@@ -613,8 +885,15 @@ def main():
 
             test_results.update(test_result)
 
-    with FileLock('log.lock'):
-        with open('log', 'a') as f:
+    if training_args.do_train:
+        # The checkpoint written in the background (persist_checkpoint) must be complete when the run ends
+        trainer.finish_checkpoint()
+
+    if extra_result is not None:
+        final_result.update(extra_result)
+
+    with FileLock(log_file + '.lock'):
+        with open(log_file, 'a') as f:
             final_result.update(vars(model_args))
             final_result.update(vars(training_args))
             final_result.update(vars(data_args))
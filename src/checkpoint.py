@@ -0,0 +1,75 @@
+"""In-memory checkpoints (snapshots of the best model) and their persistence in the background."""
+
+import os
+import threading
+import torch
+
+from transformers.file_utils import WEIGHTS_NAME
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def snapshot_state_dict(model):
+    """
+    Copy of the model's state dict on the CPU. The copy never aliases the parameters, so training can go on.
+    """
+    return {name: tensor.detach().to("cpu", copy=True) for name, tensor in model.state_dict().items()}
+
+
+class CheckpointWriter:
+    """
+    Write snapshots to disk on a background thread, in the layout of `save_pretrained` (so that `from_pretrained`
+    can load them). Only the latest snapshot matters: one that is still waiting when a newer one comes in is dropped.
+    """
+
+    def __init__(self, config, output_dir, training_args=None):
+        self.config = config
+        self.output_dir = output_dir
+        self.training_args = training_args
+        self.pending = None
+        self.closed = False
+        self.num_written = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, state_dict, step=None):
+        with self.condition:
+            self.pending = (state_dict, step)
+            self.condition.notify()
+
+    def _write(self, state_dict, step):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.config.save_pretrained(self.output_dir)
+        # Write to a temporary file first, so that a crash never leaves a truncated checkpoint
+        output_model_file = os.path.join(self.output_dir, WEIGHTS_NAME)
+        torch.save(state_dict, output_model_file + ".tmp")
+        os.replace(output_model_file + ".tmp", output_model_file)
+        if self.training_args is not None:
+            torch.save(self.training_args, os.path.join(self.output_dir, "training_args.bin"))
+        self.num_written += 1
+        logger.info("Checkpoint (step {}) written to {}".format(step, self.output_dir))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                state_dict, step = self.pending
+                self.pending = None
+            try:
+                self._write(state_dict, step)
+            except Exception:
+                logger.exception("Failed to write the checkpoint to {}".format(self.output_dir))
+
+    def close(self):
+        """
+        Wait for the latest snapshot to be written.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
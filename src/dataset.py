@@ -1,7 +1,10 @@
 """Dataset utils for different data settings for GLUE."""
 
 import os
+import re
 import copy
+import functools
+import threading
 import logging
 import torch
 import numpy as np
@@ -11,18 +14,27 @@ import json
 import itertools
 import random
 import transformers
+from src.token_cache import get_token_cache
+from src.feature_cache import featurization_key, TokenStore, FeatureRow
 from src.processors import processors_mapping, num_labels_mapping, output_modes_mapping, compute_metrics_mapping, median_mapping
 from transformers.data.processors.utils import InputFeatures
 from transformers import DataProcessor, InputExample
 import dataclasses
 from dataclasses import dataclass
-from typing import List, Optional, Union
-from sentence_transformers import SentenceTransformer, util
+from typing import List, Optional, Tuple, Union
 from copy import deepcopy
 import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# Dev/test features are built (and their demonstrations sampled) in chunks of this many examples
+FEATURE_CHUNK_SIZE = 1024
+
+# Number of chunks kept in memory when building features on demand
+MAX_CACHED_CHUNKS = 2
+
 @dataclass(frozen=True)
 class OurInputFeatures(InputFeatures):
     """
@@ -57,6 +69,84 @@ def input_example_to_tuple(example):
     else:
         return [example.text_a, example.text_b]
 
+@dataclass(frozen=True)
+class TemplateOp:
+    """
+    One step of a compiled template program (see `compile_template`).
+    """
+
+    kind: str # 'tokens', 'sent', 'label', 'labelx' or 'segment'
+    token_ids: Tuple[int, ...] = () # Pre-encoded ids (only for 'tokens')
+    index: Optional[int] = None # Sentence id / label id / support instance id
+    variant: str = '' # Sentence transform: '+' add space, 'l'/'u' lower/upper case the first char, '-' delete the last char
+    limit: Optional[int] = None # Truncation limit of the sentence
+
+
+_sent_pattern = re.compile(r'^(\+?)sent([lu]?)(-?)_(\d+)$')
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(template, tokenizer, first_sent_limit=None, other_sent_limit=None):
+    """
+    Parse a template once into a tuple of `TemplateOp`, so that featurization only needs to run the program.
+    Prompt literals are encoded here, so they are not re-encoded for every example.
+
+    Template example: '*cls*It was*mask*.*sent_0**<sep>*label_0:*sent_1**<sep>**label_1*:*sent_2**<sep>*'
+    *xx* represent variables:
+        *cls*: cls_token
+        *mask*: mask_token
+        *sep*: sep_token
+        *sep+*: sep_token, also means +1 for segment id
+        *sent_i*: sentence i (input_text_list[i])
+        *sent-_i*: same as above, but delete the last token
+        *sentl_i*: same as above, but use lower case for the first word
+        *sentl-_i*: same as above, but use lower case for the first word and delete the last token
+        *+sent_i*: same as above, but add a space before the sentence
+        *+sentl_i*: same as above, but add a space before the sentence and use lower case for the first word
+        *label_i*: label_word_list[i]
+        *label_x*: label depends on the example id (support_labels needed). this is only used in GPT-3's in-context learning
+
+    Use "_" to replace space.
+    PAY ATTENTION TO SPACE!! DO NOT leave space before variables, for this will lead to extra space token.
+    """
+    special_token_mapping = {
+        'cls': tokenizer.cls_token_id, 'mask': tokenizer.mask_token_id, 'sep': tokenizer.sep_token_id, 'sep+': tokenizer.sep_token_id, 
+    }
+
+    program = []
+    for part in template.split('*'):
+        if part in special_token_mapping:
+            if part == 'cls' and 'T5' in type(tokenizer).__name__:
+                # T5 does not have cls token
+                continue
+            program.append(TemplateOp('tokens', token_ids=(special_token_mapping[part],)))
+            if part == 'sep+':
+                program.append(TemplateOp('segment'))
+        elif part[:6] == 'label_':
+            # Note that label_word_list already has extra space, so do not add more space ahead of it.
+            program.append(TemplateOp('label', index=int(part.split('_')[1])))
+        elif part[:7] == 'labelx_':
+            program.append(TemplateOp('labelx', index=int(part.split('_')[1])))
+        elif _sent_pattern.match(part):
+            space, case, delete, sent_id = _sent_pattern.match(part).groups()
+            sent_id = int(sent_id)
+            # Limit the sentence length
+            limit = first_sent_limit if sent_id == 0 else other_sent_limit
+            program.append(TemplateOp('sent', index=sent_id, variant=space + case + delete, limit=limit))
+        else:
+            # Just natural language prompt
+            part = part.replace('_', ' ') 
+            # handle special case when T5 tokenizer might add an extra space
+            if len(part) == 1:
+                token_ids = (tokenizer._convert_token_to_id(part),)
+            else:
+                token_ids = tuple(tokenizer.encode(part, add_special_tokens=False))
+            if len(token_ids) > 0:
+                program.append(TemplateOp('tokens', token_ids=token_ids))
+
+    return tuple(program)
+
+
 def tokenize_multipart_input(
     input_text_list, 
     max_length, 
@@ -70,9 +160,13 @@ def tokenize_multipart_input(
     gpt3=False,
     truncate_head=False,
     support_labels=None,
+    pad_to_max_length=True,
+    encode_sentence=None,
 ):
-    def enc(text):
-        return tokenizer.encode(text, add_special_tokens=False)
+    # Sentences are encoded through the (per tokenizer) token cache, since the same sentences are repeated
+    # across demonstrations and samples. encode_sentence(index, variant, limit), if given, returns the (truncated)
+    # token ids of sentence `index` instead, e.g., from the support bank of `FewShotDataset`.
+    token_cache = get_token_cache(tokenizer)
 
     input_ids = []
     attention_mask = []
@@ -80,120 +174,33 @@ def tokenize_multipart_input(
     mask_pos = None # Position of the mask token
 
     if prompt:
-        """
-        Concatenate all sentences and prompts based on the provided template.
-        Template example: '*cls*It was*mask*.*sent_0**<sep>*label_0:*sent_1**<sep>**label_1*:*sent_2**<sep>*'
-        *xx* represent variables:
-            *cls*: cls_token
-            *mask*: mask_token
-            *sep*: sep_token
-            *sep+*: sep_token, also means +1 for segment id
-            *sent_i*: sentence i (input_text_list[i])
-            *sent-_i*: same as above, but delete the last token
-            *sentl_i*: same as above, but use lower case for the first word
-            *sentl-_i*: same as above, but use lower case for the first word and delete the last token
-            *+sent_i*: same as above, but add a space before the sentence
-            *+sentl_i*: same as above, but add a space before the sentence and use lower case for the first word
-            *label_i*: label_word_list[i]
-            *label_x*: label depends on the example id (support_labels needed). this is only used in GPT-3's in-context learning
-
-        Use "_" to replace space.
-        PAY ATTENTION TO SPACE!! DO NOT leave space before variables, for this will lead to extra space token.
-        """
+        # Concatenate all sentences and prompts based on the provided template (see `compile_template` for the format).
         assert template is not None
 
-        special_token_mapping = {
-            'cls': tokenizer.cls_token_id, 'mask': tokenizer.mask_token_id, 'sep': tokenizer.sep_token_id, 'sep+': tokenizer.sep_token_id, 
-        }
-        template_list = template.split('*') # Get variable list in the template
         segment_id = 0 # Current segment id. Segment id +1 if encountering sep+.
 
-        for part_id, part in enumerate(template_list):
-            new_tokens = []
-            segment_plus_1_flag = False
-            if part in special_token_mapping:
-                if part == 'cls' and 'T5' in type(tokenizer).__name__:
-                    # T5 does not have cls token
-                    continue
-                new_tokens.append(special_token_mapping[part])
-                if part == 'sep+':
-                    segment_plus_1_flag = True
-            elif part[:6] == 'label_':
-                # Note that label_word_list already has extra space, so do not add more space ahead of it.
-                label_id = int(part.split('_')[1])
-                label_word = label_word_list[label_id]
-                new_tokens.append(label_word)
-            elif part[:7] == 'labelx_':
-                instance_id = int(part.split('_')[1])
-                label_id = support_labels[instance_id]
-                label_word = label_word_list[label_id]
-                new_tokens.append(label_word)
-            elif part[:5] == 'sent_':
-                sent_id = int(part.split('_')[1])
-                new_tokens += enc(input_text_list[sent_id]) 
-            elif part[:6] == '+sent_':
-                # Add space
-                sent_id = int(part.split('_')[1])
-                new_tokens += enc(' ' + input_text_list[sent_id])
-            elif part[:6] == 'sent-_':
-                # Delete the last token
-                sent_id = int(part.split('_')[1])
-                new_tokens += enc(input_text_list[sent_id][:-1])
-            elif part[:6] == 'sentl_':
-                # Lower case the first token
-                sent_id = int(part.split('_')[1])
-                text = input_text_list[sent_id]
-                text = text[:1].lower() + text[1:]
-                new_tokens += enc(text)
-            elif part[:7] == '+sentl_':
-                # Lower case the first token and add space 
-                sent_id = int(part.split('_')[1])
-                text = input_text_list[sent_id]
-                text = text[:1].lower() + text[1:]
-                new_tokens += enc(' ' + text)
-            elif part[:7] == 'sentl-_':
-                # Lower case the first token and discard the last token
-                sent_id = int(part.split('_')[1])
-                text = input_text_list[sent_id]
-                text = text[:1].lower() + text[1:]
-                new_tokens += enc(text[:-1])
-            elif part[:6] == 'sentu_':
-                # Upper case the first token
-                sent_id = int(part.split('_')[1])
-                text = input_text_list[sent_id]
-                text = text[:1].upper() + text[1:]
-                new_tokens += enc(text)
-            elif part[:7] == '+sentu_':
-                # Upper case the first token and add space
-                sent_id = int(part.split('_')[1])
-                text = input_text_list[sent_id]
-                text = text[:1].upper() + text[1:]
-                new_tokens += enc(' ' + text)
-            else:
-                # Just natural language prompt
-                part = part.replace('_', ' ') 
-                # handle special case when T5 tokenizer might add an extra space
-                if len(part) == 1:
-                    new_tokens.append(tokenizer._convert_token_to_id(part))
-                else:
-                    new_tokens += enc(part)
-
-            if part[:4] == 'sent' or part[1:5] == 'sent':
-                # If this part is the sentence, limit the sentence length
-                sent_id = int(part.split('_')[1])
-                if sent_id == 0:
-                    if first_sent_limit is not None:
-                        new_tokens = new_tokens[:first_sent_limit]
+        for op in compile_template(template, tokenizer, first_sent_limit, other_sent_limit):
+            if op.kind == 'tokens':
+                new_tokens = list(op.token_ids)
+            elif op.kind == 'sent':
+                if encode_sentence is not None:
+                    new_tokens = list(encode_sentence(op.index, op.variant, op.limit))
                 else:
-                    if other_sent_limit is not None:
-                        new_tokens = new_tokens[:other_sent_limit]
+                    new_tokens = list(token_cache.encode(input_text_list[op.index], op.variant))
+                    if op.limit is not None:
+                        new_tokens = new_tokens[:op.limit]
+            elif op.kind == 'label':
+                new_tokens = [label_word_list[op.index]]
+            elif op.kind == 'labelx':
+                new_tokens = [label_word_list[support_labels[op.index]]]
+            else:
+                # Segment bump
+                segment_id += 1
+                continue
 
             input_ids += new_tokens
             attention_mask += [1 for i in range(len(new_tokens))]
             token_type_ids += [segment_id for i in range(len(new_tokens))]
-
-            if segment_plus_1_flag:
-                segment_id += 1
     else:
         input_ids = [tokenizer.cls_token_id]
         attention_mask = [1]
@@ -206,7 +213,7 @@ def tokenize_multipart_input(
             if pd.isna(input_text) or input_text is None:
                 # Empty input
                 input_text = ''
-            input_tokens = enc(input_text) + [tokenizer.sep_token_id]
+            input_tokens = list(token_cache.encode(input_text)) + [tokenizer.sep_token_id]
             input_ids += input_tokens
             attention_mask += [1 for i in range(len(input_tokens))]
             token_type_ids += [sent_id for i in range(len(input_tokens))]
@@ -221,7 +228,8 @@ def tokenize_multipart_input(
         # If using sentence limit, the total length still exceeds the maximum limit, report a warning
         logger.warn("Input exceeds max_length limit: {}".format(tokenizer.decode(input_ids)))
 
-    while len(input_ids) < max_length:
+    # Without padding, sequences are padded per batch (see `DynamicPaddingCollator`)
+    while pad_to_max_length and len(input_ids) < max_length:
         input_ids.append(tokenizer.pad_token_id)
         attention_mask.append(0)
         token_type_ids.append(0)
@@ -256,10 +264,186 @@ def tokenize_multipart_input(
 
 
 
+def filter_demonstrations(support_emb, query_emb, support_label_ids, num_label_buckets, filter_rate, exclude_self=False):
+    """
+    Demonstration filtering: for each query, keep the top `filter_rate` most similar (cosine similarity of the
+    sentence embeddings) support examples of each label. Returns one array of support indices per query, sorted
+    by similarity.
+
+    support_label_ids: label (bucket) id of each support example
+    exclude_self: queries are the support examples themselves (training), so do not use the query as its own demonstration
+    """
+    def normalize(emb):
+        emb = np.asarray(emb, dtype=np.float32)
+        return emb / np.maximum(np.linalg.norm(emb, axis=-1, keepdims=True), 1e-12)
+
+    num_query = len(query_emb)
+    num_candidate = len(support_emb) - (1 if exclude_self else 0)
+    limit_each_label = int(num_candidate // num_label_buckets * filter_rate)
+
+    sim = normalize(query_emb) @ normalize(support_emb).T # [num_query, num_support]
+    if exclude_self:
+        np.fill_diagonal(sim, -np.inf)
+
+    # Rank candidates by similarity (stable, so ties keep the support order)
+    order = np.argsort(-sim, axis=1, kind='stable')
+    ranked_label_ids = support_label_ids[order]
+
+    # Rank of each candidate among the candidates of the same label, and keep the top limit_each_label of each label
+    label_rank = np.cumsum(ranked_label_ids[:, :, None] == np.arange(num_label_buckets), axis=1)
+    label_rank = np.take_along_axis(label_rank, ranked_label_ids[:, :, None], axis=2)[:, :, 0] - 1
+    keep = label_rank < limit_each_label
+    if exclude_self:
+        keep &= order != np.arange(num_query)[:, None]
+
+    return [order[query_idx][keep[query_idx]] for query_idx in range(num_query)]
+
+
+class DynamicPaddingCollator:
+    """
+    Collate features by padding them to the longest sequence in the batch (with --dynamic_padding features are
+    stored unpadded, otherwise this is max_seq_length). Padding is on the right, so
+    mask positions do not change. Features of a `TokenStore` are gathered from the store's arrays directly.
+    """
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features):
+        if isinstance(features[0], FeatureRow) and all(f.store is features[0].store for f in features):
+            return features[0].store.get_batch([f.index for f in features])
+
+        batch_size = len(features)
+        max_length = max(len(f.input_ids) for f in features)
+
+        input_ids = torch.full((batch_size, max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long)
+        token_type_ids = torch.zeros((batch_size, max_length), dtype=torch.long) if features[0].token_type_ids is not None else None
+        for i, f in enumerate(features):
+            length = len(f.input_ids)
+            input_ids[i, :length] = torch.tensor(f.input_ids, dtype=torch.long)
+            attention_mask[i, :length] = torch.tensor(f.attention_mask, dtype=torch.long)
+            if token_type_ids is not None:
+                token_type_ids[i, :length] = torch.tensor(f.token_type_ids, dtype=torch.long)
+
+        batch = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if token_type_ids is not None:
+            batch['token_type_ids'] = token_type_ids
+        if features[0].mask_pos is not None:
+            batch['mask_pos'] = torch.tensor([f.mask_pos for f in features], dtype=torch.long)
+        if features[0].label is not None:
+            dtype = torch.float if isinstance(features[0].label, float) else torch.long
+            batch['labels'] = torch.tensor([f.label for f in features], dtype=dtype)
+        return batch
+
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """
+    Sequential sampler for evaluation that visits examples from the longest to the shortest, so that each batch
+    holds sequences of similar lengths (and dynamic padding pads little). `order` is kept so that predictions can be
+    put back into the dataset order.
+    """
+
+    def __init__(self, lengths):
+        self.order = np.argsort(-np.asarray(lengths), kind='stable')
+
+    def __iter__(self):
+        return iter(self.order.tolist())
+
+    def __len__(self):
+        return len(self.order)
+
+
+class LabelBuckets:
+    """
+    Support indices grouped by label (bucket), built once, so that sampling demonstrations takes a few random draws
+    per label instead of a permutation and a scan of all the candidates.
+    indices: candidate support indices; label_ids: label (bucket) id of every support example.
+    With positions, the position of each candidate in its bucket is kept, so that one candidate can be excluded.
+    """
+
+    def __init__(self, indices, label_ids, num_buckets, positions=False):
+        indices = np.asarray(indices, dtype=np.int64)
+        order = np.argsort(label_ids[indices], kind='stable')
+        self.indices = indices[order]
+        bounds = np.searchsorted(label_ids[self.indices], np.arange(num_buckets + 1))
+        self.buckets = [self.indices[bounds[b]:bounds[b + 1]] for b in range(num_buckets)]
+
+        self.positions = None
+        if positions:
+            self.positions = np.full(len(label_ids), -1, dtype=np.int64)
+            for bucket in self.buckets:
+                self.positions[bucket] = np.arange(len(bucket))
+
+    def sample(self, rng, num_per_bucket=1, exclude=None):
+        """
+        Draw (without replacement) up to num_per_bucket indices from every bucket, skipping `exclude`.
+        """
+        skip = -1
+        if exclude is not None:
+            skip = self.positions[exclude]
+        selection = []
+        for bucket in self.buckets:
+            num_candidates = len(bucket)
+            skip_position = skip if skip >= 0 and skip < num_candidates and bucket[skip] == exclude else -1
+            if skip_position >= 0:
+                num_candidates -= 1
+            num_draws = min(num_per_bucket, num_candidates)
+            if num_draws <= 0:
+                continue
+            if num_draws == 1:
+                draws = np.array([rng.randint(num_candidates)])
+            else:
+                draws = rng.choice(num_candidates, num_draws, replace=False)
+            if skip_position >= 0:
+                draws += draws >= skip_position
+            selection += bucket[draws].tolist()
+        return selection
+
+
+def map_label_words(mapping, tokenizer, label_list):
+    """
+    Map the labels to the token ids of their label words. mapping: label word mapping (a string of a dict, e.g.,
+    "{'0':'terrible','1':'great'}"). Returns the mapping (label -> token id) and the label word list (token ids of the
+    labels in order; for regression, '0' represents low polarity and '1' represents high polarity).
+    """
+    label_to_word = eval(mapping)
+
+    for key in label_to_word:
+        # For RoBERTa/BART/T5, tokenization also considers space, so we use space+word as label words.
+        if label_to_word[key][0] not in ['<', '[', '.', ',']:
+            # Make sure space+word is in the vocabulary
+            assert len(tokenizer.tokenize(' ' + label_to_word[key])) == 1
+            label_to_word[key] = tokenizer._convert_token_to_id(tokenizer.tokenize(' ' + label_to_word[key])[0])
+        else:
+            label_to_word[key] = tokenizer._convert_token_to_id(label_to_word[key])
+        logger.info("Label {} to word {} ({})".format(key, tokenizer._convert_id_to_token(label_to_word[key]), label_to_word[key]))
+
+    if len(label_list) > 1:
+        label_word_list = [label_to_word[label] for label in label_list]
+    else:
+        # Regression task
+        label_word_list = [label_to_word[label] for label in ['0', '1']]
+    return label_to_word, label_word_list
+
+
+# Dataset being featurized by a worker process of the featurization pool
+_worker_dataset = None
+
+
+def _init_featurize_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _convert_chunk_in_worker(chunk_idx):
+    return _worker_dataset.convert_chunk(chunk_idx)
+
+
 class FewShotDataset(torch.utils.data.Dataset):
     """Few-shot dataset."""
 
-    def __init__(self, args, tokenizer, cache_dir=None, mode="train", use_demo=False):
+    def __init__(self, args, tokenizer, cache_dir=None, mode="train", use_demo=False, seed=None):
         self.args = args
         self.task_name = args.task_name
         self.processor = processors_mapping[args.task_name]
@@ -277,24 +461,7 @@ class FewShotDataset(torch.utils.data.Dataset):
         self.num_labels = len(self.label_list)
         if args.prompt:
             assert args.mapping is not None
-            self.label_to_word = eval(args.mapping)
-
-            for key in self.label_to_word:
-                # For RoBERTa/BART/T5, tokenization also considers space, so we use space+word as label words.
-                if self.label_to_word[key][0] not in ['<', '[', '.', ',']:
-                    # Make sure space+word is in the vocabulary
-                    assert len(tokenizer.tokenize(' ' + self.label_to_word[key])) == 1
-                    self.label_to_word[key] = tokenizer._convert_token_to_id(tokenizer.tokenize(' ' + self.label_to_word[key])[0])
-                else:
-                    self.label_to_word[key] = tokenizer._convert_token_to_id(self.label_to_word[key])
-                logger.info("Label {} to word {} ({})".format(key, tokenizer._convert_id_to_token(self.label_to_word[key]), self.label_to_word[key]))
-            
-            if len(self.label_list) > 1:
-                self.label_word_list = [self.label_to_word[label] for label in self.label_list]
-            else:
-                # Regression task
-                # '0' represents low polarity and '1' represents high polarity.
-                self.label_word_list = [self.label_to_word[label] for label in ['0', '1']]
+            self.label_to_word, self.label_word_list = map_label_words(args.mapping, tokenizer, self.label_list)
         else:
             self.label_to_word = None
             self.label_word_list = None
@@ -314,6 +481,23 @@ class FewShotDataset(torch.utils.data.Dataset):
                 
         logger.info("Total num_sample for mode %s: %d" % (mode, self.num_sample))
 
+        # Feature cache (dev/test only, since training features are generated online). The cache is keyed by a hash
+        # of everything that affects featurization. Demonstrations are sampled, so it needs a seed when using them.
+        self.feature_cache_file = None
+        if mode != "train" and args.feature_cache and (seed is not None or not self.use_demo):
+            self.feature_cache_file = os.path.join(
+                cache_dir if cache_dir is not None else args.data_dir,
+                "cached_features_{}_{}".format(mode, featurization_key(args, tokenizer, mode, self.use_demo, self.num_sample, seed)),
+            )
+            if os.path.exists(self.feature_cache_file) and not args.overwrite_cache:
+                start = time.time()
+                self.features = TokenStore.load(self.feature_cache_file)
+                self.size = len(self.features)
+                logger.info(
+                    f"Loading features from cached file {self.feature_cache_file} [took %.3f s]", time.time() - start
+                )
+                return
+
         # Load cache
         # Cache name distinguishes mode, task name, tokenizer, and length. So if you change anything beyond these elements, make sure to clear your cache.
         cached_features_file = os.path.join(
@@ -388,160 +572,286 @@ class FewShotDataset(torch.utils.data.Dataset):
  
         # Size is expanded by num_sample
         self.size = len(self.query_examples) * self.num_sample
-        
-        # Prepare examples (especially for using demonstrations)
-        support_indices = list(range(len(self.support_examples)))
-        self.example_idx = []
-        for sample_idx in range(self.num_sample):
-            for query_idx in range(len(self.query_examples)):
-                # If training, exclude the current example. Else keep all.
-                if self.use_demo and args.demo_filter:
-                    # Demonstration filtering
-                    candidate = [support_idx for support_idx in support_indices
-                                   if support_idx != query_idx or mode != "train"]
-                    sim_score = []
-                    for support_idx in candidate:
-                        sim_score.append((support_idx, util.pytorch_cos_sim(self.support_emb[support_idx], self.query_emb[query_idx])))
-                    sim_score.sort(key=lambda x: x[1], reverse=True)
-                    if self.num_labels == 1:
-                        # Regression task
-                        limit_each_label = int(len(sim_score) // 2 * args.demo_filter_rate)
-                        count_each_label = {'0': 0, '1': 0}
-                        context_indices = []
-
-                        if args.debug_mode:
-                            print("Query %s: %s" % (self.query_examples[query_idx].label, self.query_examples[query_idx].text_a)) # debug
-                        for support_idx, score in sim_score:
-                            if count_each_label['0' if float(self.support_examples[support_idx].label) <= median_mapping[args.task_name] else '1'] < limit_each_label:
-                                count_each_label['0' if float(self.support_examples[support_idx].label) <= median_mapping[args.task_name] else '1'] += 1
-                                context_indices.append(support_idx)
-                                if args.debug_mode:
-                                    print("    %.4f %s | %s" % (score, self.support_examples[support_idx].label, self.support_examples[support_idx].text_a)) # debug
-                    else:
-                        limit_each_label = int(len(sim_score) // self.num_labels * args.demo_filter_rate)
-                        count_each_label = {label: 0 for label in self.label_list}
-                        context_indices = []
-
-                        if args.debug_mode:
-                            print("Query %s: %s" % (self.query_examples[query_idx].label, self.query_examples[query_idx].text_a)) # debug
-                        for support_idx, score in sim_score:
-                            if count_each_label[self.support_examples[support_idx].label] < limit_each_label:
-                                count_each_label[self.support_examples[support_idx].label] += 1
-                                context_indices.append(support_idx)
-                                if args.debug_mode:
-                                    print("    %.4f %s | %s" % (score, self.support_examples[support_idx].label, self.support_examples[support_idx].text_a)) # debug
-                else:
-                    # Using demonstrations without filtering
-                    context_indices = [support_idx for support_idx in support_indices
-                               if support_idx != query_idx or mode != "train"]
 
-                # We'll subsample context_indices further later.
-                self.example_idx.append((query_idx, context_indices, sample_idx))
+        # Demonstrations are sampled per label (bucket): the support examples are grouped by label once. For regression,
+        # the buckets are the examples below / above the median.
+        self.support_buckets = None
+        self.demo_candidates = None
+        if self.use_demo:
+            if self.num_labels == 1:
+                # Regression task
+                support_label_ids = np.array([0 if float(e.label) <= median_mapping[args.task_name] else 1 for e in self.support_examples])
+                num_label_buckets = 2
+            else:
+                label_map = {label: i for i, label in enumerate(self.label_list)}
+                support_label_ids = np.array([label_map[e.label] for e in self.support_examples])
+                num_label_buckets = self.num_labels
+            self.support_buckets = LabelBuckets(
+                np.arange(len(self.support_examples)), support_label_ids, num_label_buckets, positions=(mode == "train")
+            )
+
+        # Demonstration filtering does not depend on the sample, so the filtered candidates are computed once
+        # (for all queries in a single matrix product) and shared across samples.
+        if self.use_demo and args.demo_filter:
+            self.demo_candidates = [
+                LabelBuckets(context_indices, support_label_ids, num_label_buckets)
+                for context_indices in filter_demonstrations(
+                    self.support_emb,
+                    self.query_emb,
+                    support_label_ids,
+                    num_label_buckets,
+                    args.demo_filter_rate,
+                    exclude_self=(mode == "train"),
+                )
+            ]
+
+            if args.debug_mode:
+                for query_idx, context in enumerate(self.demo_candidates):
+                    print("Query %s: %s" % (self.query_examples[query_idx].label, self.query_examples[query_idx].text_a)) # debug
+                    for support_idx in context.indices:
+                        print("    %s | %s" % (self.support_examples[support_idx].label, self.support_examples[support_idx].text_a)) # debug
+
+        # Prepare examples (especially for using demonstrations). Example i is the query i % num_query in the sample
+        # i // num_query, and its demonstration candidates are label buckets shared across samples (see `get_example_idx`),
+        # so nothing here scales with num_sample x support size.
+        self.seed = seed
+
+        # With demonstrations, the support sentences are tokenized once (for every variant used by the templates),
+        # and demonstrations are assembled from the cached ids
+        self.support_bank = self.build_support_bank() if self.use_demo and args.prompt else None
 
         # If it is not training, we pre-process the data; otherwise, we process the data online.
-        if mode != "train":
+        # In lazy mode, dev/test features are also built on demand, chunk by chunk (see `get_lazy_feature`).
+        self.lazy = mode != "train" and args.lazy_features
+        self.chunks = OrderedDict()
+        self.prefetch_futures = {}
+        self.prefetch_executor = None
+        self.chunk_lock = threading.Lock()
+        if mode != "train" and not self.lazy:
+            start = time.time()
             self.features = []
-            _ = 0
-            for query_idx, context_indices, bootstrap_idx in self.example_idx:
-                # The input (query) example
-                example = self.query_examples[query_idx]
-                # The demonstrations
-                supports = self.select_context([self.support_examples[i] for i in context_indices])
-
-                if args.template_list is not None:
-                    template = args.template_list[sample_idx % len(args.template_list)] # Use template in order
-                else:
-                    template = args.template
-
-                self.features.append(self.convert_fn(
-                    example=example,
-                    supports=supports,
-                    use_demo=self.use_demo,
-                    label_list=self.label_list,
-                    prompt=args.prompt,
-                    template=template,
-                    label_word_list=self.label_word_list,
-                    verbose=True if _ == 0 else False,
-                ))
-
-                _ += 1
+            # Without a seed, demonstrations come from the global generator, which only the main process can use
+            num_workers = min(args.featurize_workers, self.num_chunks()) if self.seed is not None else 0
+            if num_workers > 1:
+                # Chunks are seeded independently, so they can be built in any process. Results come back in chunk
+                # order, which keeps the (sample, query) layout that the metrics rely on.
+                with ProcessPoolExecutor(
+                    max_workers=num_workers, initializer=_init_featurize_worker, initargs=(self,)
+                ) as executor:
+                    for chunk in executor.map(_convert_chunk_in_worker, range(self.num_chunks())):
+                        self.features += chunk
+            else:
+                for chunk_idx in range(self.num_chunks()):
+                    self.features += self.convert_chunk(chunk_idx, verbose=(chunk_idx == 0))
+                logger.info("Token cache: {}".format(get_token_cache(tokenizer).stats()))
+            logger.info(
+                "Built %d features with %d worker(s) [took %.3f s]", len(self.features), max(num_workers, 1), time.time() - start
+            )
+
+            # Keep the features as arrays instead of Python objects
+            self.features = TokenStore.from_features(self.features, pad_token_id=tokenizer.pad_token_id)
+
+            if self.feature_cache_file is not None:
+                start = time.time()
+                self.features.save(self.feature_cache_file)
+                # Use the memory-mapped store from now on
+                self.features = TokenStore.load(self.feature_cache_file)
+                logger.info(
+                    "Saving features into cached file %s [took %.3f s]", self.feature_cache_file, time.time() - start
+                )
         else:
+            if self.lazy:
+                logger.info("Build features on demand in chunks of %d examples" % FEATURE_CHUNK_SIZE)
             self.features = None
 
-    def select_context(self, context_examples):
+    def get_example_idx(self, i):
         """
-        Select demonstrations from provided examples.
+        Returns the query index, the demonstration candidates (`LabelBuckets`), the support index to exclude from
+        the candidates and the sample index of example i.
         """
-        max_demo_per_label = 1
-        counts = {k: 0 for k in self.label_list}
-        if len(self.label_list) == 1:
-            # Regression
-            counts = {'0': 0, '1': 0}
-        selection = []
+        query_idx = i % len(self.query_examples)
+        sample_idx = i // len(self.query_examples)
+        exclude = None
+        if self.demo_candidates is not None:
+            # Demonstration filtering
+            context = self.demo_candidates[query_idx]
+        else:
+            context = self.support_buckets
+            if self.mode == "train":
+                # If training, exclude the current example. Else keep all.
+                exclude = query_idx
+        return query_idx, context, exclude, sample_idx
+
+    def convert_example(self, i, rng=None, verbose=False):
+        """
+        Build the features of example i. rng: random generator for sampling the demonstrations.
+        """
+        query_idx, context, exclude, sample_idx = self.get_example_idx(i)
+        # The input (query) example
+        example = self.query_examples[query_idx]
+        # The demonstrations (we subsample the candidates here)
+        support_indices = self.select_context(context, rng=rng, exclude=exclude) if self.use_demo else []
+        return self.convert_query(example, support_indices, sample_idx, verbose=verbose)
+
+    def convert_input(self, text_a, text_b=None, sample_idx=0, rng=None):
+        """
+        Build the features of a new (unlabeled) input, e.g., for serving. Demonstrations are sampled from all the
+        support examples (there are no embeddings for demonstration filtering).
+        """
+        example = InputExample(guid="input", text_a=text_a, text_b=text_b, label=None)
+        support_indices = self.select_context(self.support_buckets, rng=rng) if self.use_demo else []
+        return self.convert_query(example, support_indices, sample_idx)
+
+    def convert_query(self, example, support_indices, sample_idx, verbose=False):
+        if self.args.template_list is not None:
+            template = self.args.template_list[sample_idx % len(self.args.template_list)] # Use template in order
+        else:
+            template = self.args.template
+
+        return self.convert_fn(
+            example=example,
+            supports=[self.support_examples[j] for j in support_indices],
+            support_indices=support_indices,
+            use_demo=self.use_demo,
+            label_list=self.label_list,
+            prompt=self.args.prompt,
+            template=template,
+            label_word_list=self.label_word_list,
+            verbose=verbose,
+        )
+
+    def num_chunks(self):
+        return (self.size + FEATURE_CHUNK_SIZE - 1) // FEATURE_CHUNK_SIZE
+
+    def convert_chunk(self, chunk_idx, verbose=False):
+        """
+        Build the features of the examples in chunk chunk_idx. Demonstrations are sampled from a generator seeded by
+        (seed, chunk_idx), so that features are reproducible no matter in which order (or where) the chunks are built.
+        """
+        rng = np.random.RandomState([self.seed, chunk_idx]) if self.seed is not None else None
+        start = chunk_idx * FEATURE_CHUNK_SIZE
+        end = min(start + FEATURE_CHUNK_SIZE, self.size)
+        return [self.convert_example(i, rng=rng, verbose=(verbose and i == start)) for i in range(start, end)]
+
+    def get_lazy_feature(self, i):
+        chunk_idx = i // FEATURE_CHUNK_SIZE
+        chunk = self.get_chunk(chunk_idx)
+        # Evaluation reads the examples in order, so prepare the next chunk in the background
+        self.prefetch_chunk(chunk_idx + 1)
+        return chunk[i - chunk_idx * FEATURE_CHUNK_SIZE]
+
+    def get_chunk(self, chunk_idx):
+        with self.chunk_lock:
+            chunk = self.chunks.get(chunk_idx)
+            if chunk is not None:
+                self.chunks.move_to_end(chunk_idx)
+                return chunk
+            future = self.prefetch_futures.pop(chunk_idx, None)
+
+        chunk = future.result() if future is not None else self.convert_chunk(chunk_idx)
+
+        with self.chunk_lock:
+            # Only keep the most recent chunks in memory
+            self.chunks[chunk_idx] = chunk
+            while len(self.chunks) > MAX_CACHED_CHUNKS:
+                self.chunks.popitem(last=False)
+        return chunk
+
+    def prefetch_chunk(self, chunk_idx):
+        if chunk_idx >= self.num_chunks():
+            return
+        with self.chunk_lock:
+            if chunk_idx in self.chunks or chunk_idx in self.prefetch_futures:
+                return
+            if self.prefetch_executor is None:
+                self.prefetch_executor = ThreadPoolExecutor(max_workers=1)
+            self.prefetch_futures[chunk_idx] = self.prefetch_executor.submit(self.convert_chunk, chunk_idx)
+
+    def __getstate__(self):
+        # Threads and locks cannot be pickled (e.g., for dataloader workers)
+        state = self.__dict__.copy()
+        state['chunks'] = OrderedDict()
+        state['prefetch_futures'] = {}
+        state['prefetch_executor'] = None
+        state.pop('chunk_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.chunk_lock = threading.Lock()
+
+    def select_context(self, context, rng=None, exclude=None):
+        """
+        Select demonstrations from the candidates `context` (`LabelBuckets`) and return their (support) indices.
+        rng: random generator to sample from (default: np.random); exclude: support index that cannot be selected.
+        """
+        if rng is None:
+            rng = np.random
 
         if self.args.gpt3_in_context_head or self.args.gpt3_in_context_tail:
             # For GPT-3's in-context learning, we sample gpt3_in_context_num demonstrations randomly. 
-            order = np.random.permutation(len(context_examples))
-            for i in range(min(self.args.gpt3_in_context_num, len(order))):
-                selection.append(context_examples[order[i]])
+            candidates = context.indices if exclude is None else context.indices[context.indices != exclude]
+            order = rng.permutation(len(candidates))
+            selection = candidates[order[:self.args.gpt3_in_context_num]].tolist()
         else:
-            # Our sampling strategy
-            order = np.random.permutation(len(context_examples))
-
-            for i in order:
-                label = context_examples[i].label
-                if len(self.label_list) == 1:
-                    # Regression
-                    label = '0' if float(label) <= median_mapping[self.args.task_name] else '1'
-                if counts[label] < max_demo_per_label:
-                    selection.append(context_examples[i])
-                    counts[label] += 1
-                if sum(counts.values()) == len(counts) * max_demo_per_label:
-                    break
-        
+            # Our sampling strategy: demo_per_label demonstrations of each label
+            selection = context.sample(rng, self.args.demo_per_label, exclude=exclude)
             assert len(selection) > 0
-        
+
         return selection
 
+    def build_support_bank(self):
+        """
+        Token ids of every support sentence under every (variant, limit) of the sentence variables of the templates.
+        Keys are (sentence index in the support example, variant, limit); values are lists indexed by support example.
+        """
+        token_cache = get_token_cache(self.tokenizer)
+        templates = self.args.template_list if self.args.template_list is not None else [self.args.template]
+        support_texts = [input_example_to_tuple(e) for e in self.support_examples]
+        num_sentences = max([len(texts) for texts in support_texts], default=0)
+
+        support_bank = {}
+        for template in templates:
+            for op in compile_template(template, self.tokenizer, self.args.first_sent_limit, self.args.other_sent_limit):
+                if op.kind != 'sent':
+                    continue
+                for k in range(num_sentences):
+                    if (k, op.variant, op.limit) in support_bank:
+                        continue
+                    ids = []
+                    for texts in support_texts:
+                        token_ids = token_cache.encode(texts[k], op.variant) if k < len(texts) else None
+                        ids.append(token_ids[:op.limit] if token_ids is not None and op.limit is not None else token_ids)
+                    support_bank[(k, op.variant, op.limit)] = ids
+        return support_bank
+
     def __len__(self):
         return self.size
 
     def __getitem__(self, i):
-        if self.features is None:
-            query_idx, context_indices, bootstrap_idx = self.example_idx[i]
-            # The input (query) example
-            example = self.query_examples[query_idx]
-            # The demonstrations
-            supports = self.select_context([self.support_examples[i] for i in context_indices])
-
-            if self.args.template_list is not None:
-                template = self.args.template_list[sample_idx % len(self.args.template_list)]
-            else:
-                template = self.args.template
-
-            features = self.convert_fn(
-                example=example,
-                supports=supports,
-                use_demo=self.use_demo,
-                label_list=self.label_list,
-                prompt=self.args.prompt,
-                template=template,
-                label_word_list=self.label_word_list,
-                verbose=False,
-            )
-        else:
-            features = self.features[i]
-            
-        return features
+        if self.features is not None:
+            return self.features[i]
+        if self.lazy:
+            return self.get_lazy_feature(i)
+        return self.convert_example(i)
 
     def get_labels(self):
         return self.label_list
 
+    def get_lengths(self):
+        """
+        Number of non-padding tokens of each feature (only for pre-processed, i.e., dev/test, datasets).
+        """
+        if isinstance(self.features, TokenStore):
+            return self.features.num_tokens()
+        return np.array([sum(f.attention_mask) for f in self.features], dtype=np.int64)
+
 
     def convert_fn(
         self,
         example,
         supports,
+        support_indices=None,
         use_demo=False,
         label_list=None,
         prompt=False,
@@ -550,7 +860,8 @@ class FewShotDataset(torch.utils.data.Dataset):
         verbose=False
     ):
         """
-        Returns a list of processed "InputFeatures".
+        Returns a list of processed "InputFeatures". support_indices: indices of the supports (demonstrations) in
+        support_examples, so that their token ids are read from the support bank.
         """
         max_length = self.args.max_seq_length    
 
@@ -583,6 +894,7 @@ class FewShotDataset(torch.utils.data.Dataset):
                 first_sent_limit=self.args.first_sent_limit,
                 other_sent_limit=self.args.other_sent_limit,
                 truncate_head=self.args.truncate_head,
+                pad_to_max_length=not self.args.dynamic_padding,
             )
             features = OurInputFeatures(**inputs, label=example_label)
 
@@ -604,31 +916,53 @@ class FewShotDataset(torch.utils.data.Dataset):
             # in-context learning, the input (query) might be at the end instead of the beginning (gpt3_in_context_head)
             augmented_example = []
             query_text = input_example_to_tuple(example) # Input sentence list for query
+            num_query_sentences = len(query_text)
             support_by_label = [[] for i in range(len(label_map))]
+            # (support index, sentence index in the support) of each demonstration sentence, for the support bank
+            support_sources = []
+            sources_by_label = [[] for i in range(len(label_map))]
+            if support_indices is None:
+                support_indices = [None] * len(supports)
 
             if self.args.gpt3_in_context_head or self.args.gpt3_in_context_tail:
                 support_labels = []
                 augmented_example = query_text
-                for support_example in supports:
-                    augmented_example += input_example_to_tuple(support_example)
+                for support_idx, support_example in zip(support_indices, supports):
+                    support_text = input_example_to_tuple(support_example)
+                    augmented_example += support_text
+                    support_sources += [(support_idx, k) for k in range(len(support_text))]
                     current_label = support_example.label
                     if len(label_list) == 1:
                         current_label = '0' if float(current_label) <= median_mapping[self.args.task_name] else '1' # Regression
                     support_labels.append(label_map[current_label])
             else:
                 # Group support examples by label
-                for label_name, label_id in label_map.items():
+                for support_idx, support_example in zip(support_indices, supports):
                     if len(label_list) == 1:
                         # Regression
-                        for support_example in filter(lambda s: ('0' if float(s.label) <= median_mapping[self.args.task_name] else '1') == label_name, supports):
-                            support_by_label[label_id] += input_example_to_tuple(support_example)
+                        label_name = '0' if float(support_example.label) <= median_mapping[self.args.task_name] else '1'
                     else:
-                        for support_example in filter(lambda s: s.label == label_name, supports):
-                            support_by_label[label_id] += input_example_to_tuple(support_example)
+                        label_name = support_example.label
+                    support_text = input_example_to_tuple(support_example)
+                    support_by_label[label_map[label_name]] += support_text
+                    sources_by_label[label_map[label_name]] += [(support_idx, k) for k in range(len(support_text))]
 
                 augmented_example = query_text
                 for label_id in range(len(label_map)):
                     augmented_example += support_by_label[label_id]
+                    support_sources += sources_by_label[label_id]
+
+            use_support_bank = self.support_bank is not None and None not in support_indices
+            token_cache = get_token_cache(self.tokenizer)
+
+            def encode_sentence(index, variant, limit):
+                if index >= num_query_sentences:
+                    support_idx, k = support_sources[index - num_query_sentences]
+                    bank_ids = self.support_bank.get((k, variant, limit))
+                    if bank_ids is not None:
+                        return bank_ids[support_idx]
+                token_ids = token_cache.encode(augmented_example[index], variant)
+                return token_ids[:limit] if limit is not None else token_ids
 
             # Tokenization (based on the template)
             inputs = tokenize_multipart_input(
@@ -642,8 +976,10 @@ class FewShotDataset(torch.utils.data.Dataset):
                 first_sent_limit=self.args.first_sent_limit,
                 other_sent_limit=self.args.other_sent_limit,
                 truncate_head=self.args.truncate_head,
+                pad_to_max_length=not self.args.dynamic_padding,
                 gpt3=self.args.gpt3_in_context_head or self.args.gpt3_in_context_tail,
-                support_labels=None if not (self.args.gpt3_in_context_head or self.args.gpt3_in_context_tail) else support_labels
+                support_labels=None if not (self.args.gpt3_in_context_head or self.args.gpt3_in_context_tail) else support_labels,
+                encode_sentence=encode_sentence if use_support_bank else None,
             )
             features = OurInputFeatures(**inputs, label=example_label)
 
@@ -0,0 +1,58 @@
+"""Device and CPU thread settings shared by run.py and the tools."""
+
+import os
+import torch
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def default_device():
+    """
+    The device to run on when none is given: the (first) GPU if there is one, else the CPU.
+    """
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parse a list of CPU cores in the format of taskset / cgroups, e.g., "0-7,16-23".
+    """
+    cores = []
+    for part in cpu_list.split(','):
+        part = part.strip()
+        if len(part) == 0:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cores += list(range(int(first), int(last) + 1))
+        else:
+            cores.append(int(part))
+    return sorted(set(cores))
+
+
+def configure_cpu_threads(intra_op_threads=0, inter_op_threads=0, cpu_affinity=None):
+    """
+    Limit the CPU threads of this process, e.g., to pack several runs on one host without oversubscription.
+        intra_op_threads: threads used inside an op (torch.set_num_threads); 0 keeps the PyTorch default
+        inter_op_threads: threads running independent ops (torch.set_num_interop_threads); 0 keeps the default
+        cpu_affinity: cores to pin the process to (e.g., "0-7"); the thread pools created afterwards inherit it
+    Call it before running anything with PyTorch (the number of inter-op threads can only be set once).
+    """
+    if cpu_affinity is not None:
+        cores = parse_cpu_list(cpu_affinity)
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        else:
+            logger.warning("CPU affinity is not supported on this platform, ignoring cpu_affinity")
+        if intra_op_threads <= 0:
+            # One thread per pinned core
+            intra_op_threads = len(cores)
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        torch.set_num_interop_threads(inter_op_threads)
+    logger.info(
+        "CPU threads: intra-op %d, inter-op %d, affinity %s"
+        % (torch.get_num_threads(), torch.get_num_interop_threads(), cpu_affinity if cpu_affinity is not None else "all cores")
+    )
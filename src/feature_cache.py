@@ -0,0 +1,199 @@
+"""On-disk cache of featurized (tokenized) datasets."""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Bump this whenever featurization changes in a way that is not captured by the arguments
+FEATURE_CACHE_VERSION = 5
+
+# Data arguments that affect featurization
+FEATURIZATION_ARGS = [
+    'task_name', 'max_seq_length', 'prompt', 'template', 'template_list', 'mapping',
+    'first_sent_limit', 'other_sent_limit', 'truncate_head', 'double_demo',
+    'gpt3_in_context_head', 'gpt3_in_context_tail', 'gpt3_in_context_num',
+    'demo_filter', 'demo_filter_rate', 'demo_filter_model', 'demo_per_label', 'dynamic_padding',
+]
+
+
+def data_signature(data_dir):
+    """
+    Names, sizes and modification times of the data files (datasets and embeddings) in data_dir.
+    """
+    signature = []
+    for name in sorted(os.listdir(data_dir)):
+        if name.startswith("cached_") or name.endswith(".lock"):
+            continue
+        stat = os.stat(os.path.join(data_dir, name))
+        signature.append([name, stat.st_size, int(stat.st_mtime)])
+    return signature
+
+
+def featurization_key(args, tokenizer, mode, use_demo, num_sample, seed):
+    """
+    Hash of everything that affects the features of a dataset.
+    """
+    config = {
+        'version': FEATURE_CACHE_VERSION,
+        'mode': mode,
+        'use_demo': use_demo,
+        'num_sample': num_sample,
+        # Demonstrations are sampled, so the features also depend on the seed
+        'seed': seed if use_demo else None,
+        'tokenizer': [tokenizer.__class__.__name__, getattr(tokenizer, 'name_or_path', None), len(tokenizer)],
+        'data': data_signature(args.data_dir),
+    }
+    for name in FEATURIZATION_ARGS:
+        config[name] = getattr(args, name, None)
+
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class FeatureRow:
+    """
+    One feature of a `TokenStore`. Exposes the fields of `OurInputFeatures` (read from the store on access), and
+    lets `DynamicPaddingCollator` gather whole batches from the store at once.
+    """
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def _tokens(self, name):
+        if name not in self.store.columns:
+            return None
+        return self.store.columns[name][self.index, :self.store.lengths[self.index]].tolist()
+
+    @property
+    def input_ids(self):
+        return self._tokens('input_ids')
+
+    @property
+    def attention_mask(self):
+        return self._tokens('attention_mask')
+
+    @property
+    def token_type_ids(self):
+        return self._tokens('token_type_ids')
+
+    @property
+    def mask_pos(self):
+        return [int(self.store.columns['mask_pos'][self.index])] if 'mask_pos' in self.store.columns else None
+
+    @property
+    def label(self):
+        return self.store.columns['label'][self.index].item() if 'label' in self.store.columns else None
+
+    @property
+    def label_word_list(self):
+        return None
+
+    def __repr__(self):
+        return "FeatureRow(index={}, input_ids={}, mask_pos={}, label={})".format(
+            self.index, self.input_ids, self.mask_pos, self.label
+        )
+
+
+class TokenStore:
+    """
+    Struct-of-arrays storage of features: one (num_features, max_length) matrix per token field (int32 ids,
+    int8 masks / segment ids, right-padded), plus vectors of sequence lengths, mask positions and labels.
+    Indexing returns a `FeatureRow`, and `get_batch` builds the tensors of a batch with one gather per field.
+
+    Each column is a flat .npy file, memory-mapped when loaded, so that concurrent runs on one host share
+    the pages through the OS page cache instead of each holding its own unpickled copy.
+    """
+
+    TOKEN_COLUMNS = {'input_ids': np.int32, 'attention_mask': np.int8, 'token_type_ids': np.int8}
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.lengths = columns['lengths']
+        self.pad_token_id = int(columns['pad_token_id'][0])
+
+    @classmethod
+    def from_features(cls, features, pad_token_id=0):
+        columns = {}
+        num_features = len(features)
+        columns['lengths'] = np.array([len(f.input_ids) for f in features], dtype=np.int32)
+        columns['pad_token_id'] = np.array([pad_token_id], dtype=np.int64)
+        max_length = int(columns['lengths'].max()) if num_features > 0 else 0
+        for name, dtype in cls.TOKEN_COLUMNS.items():
+            if num_features > 0 and getattr(features[0], name) is not None:
+                column = np.full((num_features, max_length), pad_token_id if name == 'input_ids' else 0, dtype=dtype)
+                for i, f in enumerate(features):
+                    column[i, :len(f.input_ids)] = getattr(f, name)
+                columns[name] = column
+        if num_features > 0 and features[0].mask_pos is not None:
+            columns['mask_pos'] = np.array([f.mask_pos[0] for f in features], dtype=np.int32)
+        if num_features > 0 and features[0].label is not None:
+            columns['label'] = np.array([f.label for f in features], dtype=np.float64 if isinstance(features[0].label, float) else np.int64)
+        return cls(columns)
+
+    def save(self, path):
+        """
+        Write one .npy file per column into the directory `path`. The directory is written atomically, so
+        concurrent runs never read a partial cache.
+        """
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, column in self.columns.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), column)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another run has written the same cache in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        columns = {}
+        for name in os.listdir(path):
+            if name.endswith(".npy"):
+                columns[name[:-len(".npy")]] = np.load(os.path.join(path, name), mmap_mode='r' if mmap else None)
+        return cls(columns)
+
+    def num_tokens(self):
+        """
+        Number of non-padding tokens of each feature.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return self.columns['attention_mask'].sum(axis=1, dtype=np.int64)
+
+    def get_batch(self, indices):
+        """
+        Tensors of the features at `indices`, padded to the longest of them. A run of consecutive indices
+        (sequential evaluation) is read as a slice of the matrices instead of a gather.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1 and np.all(np.diff(indices) == 1):
+            rows = slice(int(indices[0]), int(indices[-1]) + 1)
+        else:
+            rows = indices
+        max_length = int(self.lengths[rows].max())
+
+        batch = {}
+        for name in self.TOKEN_COLUMNS:
+            if name in self.columns:
+                batch[name] = torch.from_numpy(self.columns[name][rows, :max_length].astype(np.int64))
+        if 'mask_pos' in self.columns:
+            batch['mask_pos'] = torch.from_numpy(self.columns['mask_pos'][rows].astype(np.int64)).unsqueeze(-1)
+        if 'label' in self.columns:
+            label = self.columns['label'][rows]
+            batch['labels'] = torch.from_numpy(label.astype(np.float32 if label.dtype == np.float64 else np.int64))
+        return batch
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, i):
+        return FeatureRow(self, i)
@@ -1,8 +1,11 @@
 """Custom models for few-shot learning specific operations."""
 
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import transformers
+from transformers.activations import gelu
 from transformers.modeling_bert import BertPreTrainedModel, BertForSequenceClassification, BertModel, BertOnlyMLMHead
 from transformers.modeling_roberta import RobertaForSequenceClassification, RobertaModel, RobertaLMHead, RobertaClassificationHead
 from transformers.modeling_outputs import SequenceClassifierOutput
@@ -29,6 +32,176 @@ def resize_token_type_embeddings(model, new_num_types: int, random_segment: bool
         raise NotImplementedError
 
 
+def label_word_logits(hidden_states, decoder, label_word_list):
+    """
+    Logits of the label words only: the hidden states are multiplied by the decoder rows (and bias) of the label words,
+    i.e., [batch, hidden] x [hidden, num_labels] instead of the projection over the whole vocabulary.
+    """
+    return F.linear(hidden_states, decoder.weight[label_word_list], decoder.bias[label_word_list])
+
+
+def attach_label_head(model):
+    """
+    Copy the decoder rows (and bias) of the label words into a separate nn.Linear (model.label_head), used instead of
+    the decoder in evaluation. The copy is not tied to the embeddings, so it is only meant for inference, e.g., to be
+    quantized along with the other Linear layers.
+    """
+    decoder = model.cls.predictions.decoder if hasattr(model, 'cls') else model.lm_head.decoder
+    label_head = nn.Linear(decoder.in_features, len(model.label_word_list))
+    with torch.no_grad():
+        label_head.weight.copy_(decoder.weight[model.label_word_list])
+        label_head.bias.copy_(decoder.bias[model.label_word_list])
+    model.label_head = label_head.to(decoder.weight.device)
+
+
+def roberta_lm_head_transform(lm_head, features):
+    """
+    The part of RobertaLMHead before the projection over the vocabulary.
+    """
+    x = lm_head.dense(features)
+    x = gelu(x)
+    return lm_head.layer_norm(x)
+
+
+def mask_only_layer(layer, hidden_states, extended_attention_mask, mask_pos):
+    """
+    Output of a BertLayer (RobertaLayer) at the mask positions only: the queries are restricted to the mask
+    position, while the keys and values still use all tokens. Same as layer(...)[0][arange, mask_pos].
+    """
+    self_attention = layer.attention.self
+    batch_size = hidden_states.size(0)
+    query_states = hidden_states[torch.arange(batch_size), mask_pos].unsqueeze(1)
+
+    query_layer = self_attention.transpose_for_scores(self_attention.query(query_states))
+    key_layer = self_attention.transpose_for_scores(self_attention.key(hidden_states))
+    value_layer = self_attention.transpose_for_scores(self_attention.value(hidden_states))
+
+    # [batch, heads, 1, seq_len]
+    attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2)) / math.sqrt(self_attention.attention_head_size)
+    attention_scores = attention_scores + extended_attention_mask
+    attention_probs = self_attention.dropout(nn.Softmax(dim=-1)(attention_scores))
+
+    context_layer = torch.matmul(attention_probs, value_layer).permute(0, 2, 1, 3).contiguous()
+    context_layer = context_layer.view(batch_size, 1, self_attention.all_head_size)
+
+    attention_output = layer.attention.output(context_layer, query_states)
+    layer_output = layer.output(layer.intermediate(attention_output), attention_output)
+    return layer_output[:, 0]
+
+
+def encode_mask_only(encoder_model, input_ids, attention_mask, token_type_ids, mask_pos):
+    """
+    <mask> token representation of a BertModel / RobertaModel, where the last layer is only computed at the mask
+    position (see `mask_only_layer`). Only the last layer can be restricted exactly: the outputs of every earlier
+    layer at all positions are the keys and values of the next one.
+    """
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    extended_attention_mask = encoder_model.get_extended_attention_mask(attention_mask, input_ids.size(), input_ids.device)
+
+    hidden_states = encoder_model.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+    for layer in encoder_model.encoder.layer[:-1]:
+        hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)[0]
+    return mask_only_layer(encoder_model.encoder.layer[-1], hidden_states, extended_attention_mask, mask_pos)
+
+
+class FrozenLayerCache:
+    """
+    Outputs of the frozen bottom of the encoder (the embeddings and the first num_layers layers, see fix_layers) for
+    each distinct input sequence, so that training steps only run the trainable top layers.
+
+    The frozen part is computed once per sequence, without dropout and gradients. Sequences are right padded, so only
+    the outputs at the non-padding positions are kept (the outputs of the other positions do not depend on padding).
+    If more than max_entries distinct sequences show up (the inputs vary, e.g., demonstrations sampled online),
+    the cache disables itself and `encode` returns None.
+    """
+
+    def __init__(self, num_layers, max_entries):
+        self.num_layers = num_layers
+        self.max_entries = max_entries
+        self.entries = {}
+        self.disabled = False
+        self.hits = 0
+        self.misses = 0
+
+    def frozen_forward(self, encoder_model, input_ids, attention_mask, token_type_ids):
+        frozen_modules = [encoder_model.embeddings] + list(encoder_model.encoder.layer[:self.num_layers])
+        modes = [module.training for module in frozen_modules]
+        for module in frozen_modules:
+            module.eval()
+        with torch.no_grad():
+            extended_attention_mask = encoder_model.get_extended_attention_mask(attention_mask, input_ids.size(), input_ids.device)
+            hidden_states = encoder_model.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+            for layer in encoder_model.encoder.layer[:self.num_layers]:
+                hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)[0]
+        for module, mode in zip(frozen_modules, modes):
+            module.train(mode)
+        return hidden_states
+
+    def encode(self, encoder_model, input_ids, attention_mask=None, token_type_ids=None):
+        """
+        Sequence output of a BertModel / RobertaModel, with the frozen layers read from the cache.
+        """
+        if self.disabled:
+            return None
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        lengths = attention_mask.sum(-1).tolist()
+        input_ids_np = input_ids.cpu().numpy()
+        token_type_ids_np = token_type_ids.cpu().numpy() if token_type_ids is not None else None
+        keys = []
+        for i, length in enumerate(lengths):
+            key = input_ids_np[i, :length].tobytes()
+            if token_type_ids_np is not None:
+                key += token_type_ids_np[i, :length].tobytes()
+            keys.append(key)
+
+        missing = [i for i, key in enumerate(keys) if key not in self.entries]
+        if len(self.entries) + len(set(keys[i] for i in missing)) > self.max_entries:
+            logger.info(
+                "Frozen layer cache: more than %d distinct inputs, stop caching (run the whole encoder instead)" % self.max_entries
+            )
+            self.disabled = True
+            self.entries = {}
+            return None
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            index = torch.tensor(missing, device=input_ids.device)
+            frozen_output = self.frozen_forward(
+                encoder_model,
+                input_ids[index],
+                attention_mask[index],
+                token_type_ids[index] if token_type_ids is not None else None,
+            )
+            for j, i in enumerate(missing):
+                self.entries[keys[i]] = frozen_output[j, :lengths[i]].clone()
+
+        hidden_states = torch.nn.utils.rnn.pad_sequence([self.entries[key] for key in keys], batch_first=True)
+        if hidden_states.size(1) < input_ids.size(1):
+            hidden_states = F.pad(hidden_states, (0, 0, 0, input_ids.size(1) - hidden_states.size(1)))
+
+        extended_attention_mask = encoder_model.get_extended_attention_mask(attention_mask, input_ids.size(), input_ids.device)
+        for layer in encoder_model.encoder.layer[self.num_layers:]:
+            hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)[0]
+        return hidden_states
+
+
+def use_mask_only_layer(model, mask_pos):
+    """
+    Whether the forward can compute the last layer at the mask position only (inference with model_args.mask_only_last_layer).
+    """
+    return (
+        not model.training
+        and mask_pos is not None
+        and not model.return_full_softmax
+        and getattr(model.model_args, "mask_only_last_layer", False)
+        and getattr(model.config, "position_embedding_type", "absolute") == "absolute"
+    )
+
+
 class BertForPromptFinetuning(BertPreTrainedModel):
 
     def __init__(self, config):
@@ -47,6 +220,12 @@ class BertForPromptFinetuning(BertPreTrainedModel):
         self.lb = None
         self.ub = None
 
+        # For training with fix_layers (see `FrozenLayerCache`)
+        self.frozen_layer_cache = None
+
+        # For inference with a separate label word head (see `attach_label_head`)
+        self.label_head = None
+
         # For label search.
         self.return_full_softmax = None
 
@@ -63,31 +242,38 @@ class BertForPromptFinetuning(BertPreTrainedModel):
         if mask_pos is not None:
             mask_pos = mask_pos.squeeze()
 
-        # Encode everything
-        outputs = self.bert(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids
-        )
-
-        # Get <mask> token representation
-        sequence_output, pooled_output = outputs[:2]
-        sequence_mask_output = sequence_output[torch.arange(sequence_output.size(0)), mask_pos]
-
-        # Logits over vocabulary tokens
-        prediction_mask_scores = self.cls(sequence_mask_output)
-
-        # Exit early and only return mask logits.
+        if use_mask_only_layer(self, mask_pos):
+            # Inference: the last layer is only computed at the mask position
+            sequence_mask_output = encode_mask_only(self.bert, input_ids, attention_mask, token_type_ids, mask_pos)
+        else:
+            sequence_output = None
+            if self.training and self.frozen_layer_cache is not None:
+                # Training with fix_layers: the frozen layers are read from the cache
+                sequence_output = self.frozen_layer_cache.encode(self.bert, input_ids, attention_mask, token_type_ids)
+            if sequence_output is None:
+                # Encode everything
+                outputs = self.bert(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    token_type_ids=token_type_ids
+                )
+                sequence_output = outputs[0]
+
+            # Get <mask> token representation
+            sequence_mask_output = sequence_output[torch.arange(sequence_output.size(0)), mask_pos]
+
+        # Exit early and only return mask logits (over vocabulary tokens).
         if self.return_full_softmax:
+            prediction_mask_scores = self.cls(sequence_mask_output)
             if labels is not None:
                 return torch.zeros(1, out=prediction_mask_scores.new()), prediction_mask_scores
             return prediction_mask_scores
 
-        # Return logits for each label
-        logits = []
-        for label_id in range(len(self.label_word_list)):
-            logits.append(prediction_mask_scores[:, self.label_word_list[label_id]].unsqueeze(-1))
-        logits = torch.cat(logits, -1)
+        # Return logits for each label (only the label words are projected)
+        if self.label_head is not None and not self.training:
+            logits = self.label_head(self.cls.predictions.transform(sequence_mask_output))
+        else:
+            logits = label_word_logits(self.cls.predictions.transform(sequence_mask_output), self.cls.predictions.decoder, self.label_word_list)
 
         # Regression task
         if self.config.num_labels == 1:
@@ -132,6 +318,12 @@ class RobertaForPromptFinetuning(BertPreTrainedModel):
         self.lb = None
         self.ub = None
 
+        # For training with fix_layers (see `FrozenLayerCache`)
+        self.frozen_layer_cache = None
+
+        # For inference with a separate label word head (see `attach_label_head`)
+        self.label_head = None
+
         # For auto label search.
         self.return_full_softmax = None
 
@@ -147,30 +339,37 @@ class RobertaForPromptFinetuning(BertPreTrainedModel):
         if mask_pos is not None:
             mask_pos = mask_pos.squeeze()
 
-        # Encode everything
-        outputs = self.roberta(
-            input_ids,
-            attention_mask=attention_mask
-        )
-
-        # Get <mask> token representation
-        sequence_output, pooled_output = outputs[:2]
-        sequence_mask_output = sequence_output[torch.arange(sequence_output.size(0)), mask_pos]
-
-        # Logits over vocabulary tokens
-        prediction_mask_scores = self.lm_head(sequence_mask_output)
-
-        # Exit early and only return mask logits.
+        if use_mask_only_layer(self, mask_pos):
+            # Inference: the last layer is only computed at the mask position
+            sequence_mask_output = encode_mask_only(self.roberta, input_ids, attention_mask, None, mask_pos)
+        else:
+            sequence_output = None
+            if self.training and self.frozen_layer_cache is not None:
+                # Training with fix_layers: the frozen layers are read from the cache
+                sequence_output = self.frozen_layer_cache.encode(self.roberta, input_ids, attention_mask)
+            if sequence_output is None:
+                # Encode everything
+                outputs = self.roberta(
+                    input_ids,
+                    attention_mask=attention_mask
+                )
+                sequence_output = outputs[0]
+
+            # Get <mask> token representation
+            sequence_mask_output = sequence_output[torch.arange(sequence_output.size(0)), mask_pos]
+
+        # Exit early and only return mask logits (over vocabulary tokens).
         if self.return_full_softmax:
+            prediction_mask_scores = self.lm_head(sequence_mask_output)
             if labels is not None:
                 return torch.zeros(1, out=prediction_mask_scores.new()), prediction_mask_scores
             return prediction_mask_scores
 
-        # Return logits for each label
-        logits = []
-        for label_id in range(len(self.label_word_list)):
-            logits.append(prediction_mask_scores[:, self.label_word_list[label_id]].unsqueeze(-1))
-        logits = torch.cat(logits, -1)
+        # Return logits for each label (only the label words are projected)
+        if self.label_head is not None and not self.training:
+            logits = self.label_head(roberta_lm_head_transform(self.lm_head, sequence_mask_output))
+        else:
+            logits = label_word_logits(roberta_lm_head_transform(self.lm_head, sequence_mask_output), self.lm_head.decoder, self.label_word_list)
 
         # Regression task
         if self.config.num_labels == 1:
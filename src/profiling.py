@@ -0,0 +1,195 @@
+"""Timing the phases of training steps (data, forward, backward, ...) and the training throughput."""
+
+import os
+import json
+import time
+from contextlib import contextmanager
+import torch
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Phases timed by Trainer.train, in the order of the summary
+PHASES = ["data", "collate", "forward", "backward", "optimizer", "eval", "save"]
+
+
+def peak_memory_mb(device=None, reset=False):
+    """
+    Peak memory (MB): allocated by torch on a GPU, or the peak resident set size of the process on CPU.
+    On a GPU, reset starts a new peak from the current allocation. On CPU, the peak is always the one of the
+    whole process so far (it cannot be reset).
+    """
+    if device is not None and torch.device(device).type == "cuda":
+        memory = torch.cuda.max_memory_allocated(device) / 2 ** 20
+        if reset:
+            torch.cuda.reset_peak_memory_stats(device)
+        return memory
+    if resource is not None:
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+
+class StepProfiler:
+    """
+    Time spans of the phases of training. Spans can be nested (e.g., collate inside data): a phase is charged its
+    own time only, without the spans inside it, so the phases add up to the training time (plus "other").
+    With synchronize (CUDA), the device is synchronized at the span boundaries, so that the asynchronous kernels
+    are charged to the phase that launched them. With trace, the spans are also kept for `export_chrome_trace`.
+    Disabled, spans cost nothing; the throughput counters (examples and non-padding tokens) are always kept.
+    """
+
+    def __init__(self, enabled=False, trace=False, synchronize=False, max_trace_events=1000000):
+        self.enabled = enabled
+        self.trace = trace
+        self.synchronize = synchronize
+        self.max_trace_events = max_trace_events
+        self.times = {}
+        self.counts = {}
+        self.events = []
+        self.stack = []
+        self.start_time = time.perf_counter()
+
+        self.num_examples = 0
+        self.num_tokens = 0
+        self.window_start = self.start_time
+        self.window_examples = 0
+        self.window_tokens = 0
+        # Highest peak of the windows (the GPU peak is reset at each window)
+        self.peak_memory = None
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        # Time spent in the spans inside this one
+        self.stack.append(0.0)
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            duration = time.perf_counter() - start
+            inner = self.stack.pop()
+            self.times[name] = self.times.get(name, 0.0) + duration - inner
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if len(self.stack) > 0:
+                self.stack[-1] += duration
+            if self.trace and len(self.events) < self.max_trace_events:
+                self.events.append((name, start - self.start_time, duration))
+
+    def iterate(self, iterable, name):
+        """
+        Iterate over iterable, timing each `next` (e.g., fetching the batches of a DataLoader) as a span.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def wrap(self, fn, name):
+        """
+        fn, with each call timed as a span.
+        """
+        def wrapped(*args, **kwargs):
+            with self.span(name):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    def count_batch(self, inputs):
+        """
+        Count the examples and the tokens (without padding) of a training batch.
+        """
+        input_ids = inputs.get("input_ids")
+        if input_ids is None:
+            return
+        num_tokens = int(inputs["attention_mask"].sum()) if "attention_mask" in inputs else input_ids.numel()
+        self.num_examples += input_ids.size(0)
+        self.num_tokens += num_tokens
+        self.window_examples += input_ids.size(0)
+        self.window_tokens += num_tokens
+
+    def throughput(self, device=None):
+        """
+        Examples / s and tokens / s since the previous call, and the peak memory (logged at each logging step): on a
+        GPU, the peak since the previous call; on CPU, the cumulative peak of the process.
+        """
+        now = time.perf_counter()
+        elapsed = max(now - self.window_start, 1e-6)
+        logs = {
+            "examples_per_sec": self.window_examples / elapsed,
+            "tokens_per_sec": self.window_tokens / elapsed,
+        }
+        memory = peak_memory_mb(device, reset=True)
+        if memory is not None:
+            logs["peak_memory_mb"] = memory
+            self.peak_memory = max(memory, self.peak_memory or 0.0)
+        self.window_start = now
+        self.window_examples = 0
+        self.window_tokens = 0
+        return logs
+
+    def summary(self, total_time, device=None):
+        """
+        Flat summary for the result log: the time (s) and share (%) of total_time of each phase, and the throughput
+        and peak memory of the whole training.
+        """
+        result = {
+            "train_examples_per_sec": self.num_examples / max(total_time, 1e-6),
+            "train_tokens_per_sec": self.num_tokens / max(total_time, 1e-6),
+        }
+        memory = peak_memory_mb(device)
+        if memory is not None:
+            result["peak_memory_mb"] = max(memory, self.peak_memory or 0.0)
+        if not self.enabled:
+            return result
+        phases = PHASES + sorted(set(self.times) - set(PHASES))
+        times = [(phase, self.times.get(phase, 0.0)) for phase in phases]
+        times.append(("other", max(total_time - sum(self.times.values()), 0.0)))
+        for phase, seconds in times:
+            result["profile_%s_sec" % phase] = seconds
+            result["profile_%s_pct" % phase] = 100 * seconds / max(total_time, 1e-6)
+        return result
+
+    def table(self, total_time):
+        """
+        The phases as a table, for the training log.
+        """
+        lines = ["%-10s %10s %8s %8s %12s" % ("phase", "time (s)", "%", "calls", "ms / call")]
+        for phase in PHASES + sorted(set(self.times) - set(PHASES)):
+            seconds = self.times.get(phase, 0.0)
+            calls = self.counts.get(phase, 0)
+            lines.append("%-10s %10.2f %8.1f %8d %12.2f" % (
+                phase, seconds, 100 * seconds / max(total_time, 1e-6), calls, 1000 * seconds / calls if calls > 0 else 0.0))
+        other = max(total_time - sum(self.times.values()), 0.0)
+        lines.append("%-10s %10.2f %8.1f" % ("other", other, 100 * other / max(total_time, 1e-6)))
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """
+        Write the spans as a Chrome trace (JSON), to open in chrome://tracing or Perfetto.
+        """
+        pid = os.getpid()
+        events = [
+            {"name": name, "cat": "train", "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": pid, "tid": 0}
+            for name, start, duration in self.events
+        ]
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logger.info("Chrome trace of %d spans written to %s" % (len(events), path))
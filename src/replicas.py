@@ -0,0 +1,314 @@
+"""Training several replicas of a model (e.g., one per data seed) in one pass, vectorized with torch.func."""
+
+import time
+import random
+from contextlib import contextmanager
+import numpy as np
+import torch
+
+from transformers import set_seed
+from transformers.file_utils import is_torch_tpu_available
+from transformers.optimization import AdamW, get_linear_schedule_with_warmup
+from transformers.trainer_utils import TrainOutput
+
+from src.trainer import default_dev_objective, group_parameters
+from src.checkpoint import CheckpointWriter
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Training arguments that the replicas must share (they are trained step by step together, with one schedule)
+SHARED_ARGUMENTS = [
+    "learning_rate", "weight_decay", "adam_beta1", "adam_beta2", "adam_epsilon", "max_grad_norm", "warmup_steps",
+    "max_steps", "num_train_epochs", "per_device_train_batch_size", "gradient_accumulation_steps", "fix_layers",
+    "evaluate_during_training", "eval_steps", "logging_steps", "logging_first_step",
+]
+
+
+def vmap_available():
+    """
+    Whether torch has functional transforms (torch.func, torch >= 2.0) to stack the replicas into one computation.
+    Replicas need them: without vectorization, K replicas in one process are no faster than K runs.
+    """
+    return hasattr(torch, "func") and hasattr(torch.func, "stack_module_state")
+
+
+def check_replicas(trainers):
+    if not vmap_available():
+        raise RuntimeError("Training replicas needs torch.func (torch >= 2.0), found torch {}".format(torch.__version__))
+    if not can_stack([trainer.model for trainer in trainers]):
+        raise ValueError("Replicas must be the same model (architecture, config and label words), only differing by their weights")
+    for name in SHARED_ARGUMENTS:
+        values = [getattr(trainer.args, name, None) for trainer in trainers]
+        if any(value != values[0] for value in values):
+            raise ValueError("Replicas must have the same {} (got {})".format(name, values))
+    for trainer in trainers:
+        args = trainer.args
+        if args.fp16 or args.n_gpu > 1 or args.local_rank != -1 or is_torch_tpu_available():
+            raise ValueError("Replicas are trained on a single device, without fp16")
+        if getattr(args, "early_stopping_patience", 0) > 0 or getattr(args, "time_budget", 0) > 0:
+            raise ValueError("Early stopping is not supported with replicas")
+    sizes = [len(trainer.train_dataset) for trainer in trainers]
+    if any(size != sizes[0] for size in sizes):
+        raise ValueError("Replicas must have training sets of the same size (got {})".format(sizes))
+
+
+def can_stack(models):
+    """
+    The replicas can share one functional forward if they only differ by their parameters.
+    """
+    first = models[0]
+    for model in models[1:]:
+        if type(model) is not type(first) or model.config.to_dict() != first.config.to_dict():
+            return False
+        if [n for n, _ in model.named_parameters()] != [n for n, _ in first.named_parameters()]:
+            return False
+        label_word_list = getattr(model, "label_word_list", None)
+        if label_word_list is not None and not torch.equal(label_word_list, first.label_word_list):
+            return False
+        if getattr(model, "lb", None) != getattr(first, "lb", None) or getattr(model, "ub", None) != getattr(first, "ub", None):
+            return False
+    return True
+
+
+def stack_batches(batches, pad_token_id):
+    """
+    Stack the batches of the replicas ([batch, length] tensors, dynamically padded) into [replicas, batch, length]
+    tensors, padding them to a common length.
+    """
+    stacked = {}
+    for key in batches[0]:
+        tensors = [batch[key] for batch in batches]
+        if tensors[0].dim() >= 2 and key in ["input_ids", "attention_mask", "token_type_ids"]:
+            length = max(t.size(1) for t in tensors)
+            value = pad_token_id if key == "input_ids" else 0
+            tensors = [
+                torch.cat([t, t.new_full((t.size(0), length - t.size(1)) + tuple(t.shape[2:]), value)], 1) if t.size(1) < length else t
+                for t in tensors
+            ]
+        stacked[key] = torch.stack(tensors)
+    return stacked
+
+
+class GlobalRNGState:
+    """
+    A state of the global generators (random, np.random and torch on CPU), which `Trainer.train` draws the data order
+    and the demonstrations from. Each replica runs its data loading and evaluation with its own state (`active`), so
+    it draws what `Trainer.train` with its seed would, whatever the other replicas draw.
+    """
+
+    def __init__(self):
+        self.state = self.get()
+
+    @staticmethod
+    def get():
+        return random.getstate(), np.random.get_state(), torch.get_rng_state()
+
+    @staticmethod
+    def set(state):
+        random.setstate(state[0])
+        np.random.set_state(state[1])
+        torch.set_rng_state(state[2])
+
+    @contextmanager
+    def active(self):
+        outer = self.get()
+        self.set(self.state)
+        try:
+            yield
+        finally:
+            self.state = self.get()
+            self.set(outer)
+
+
+class StackedReplicas:
+    """
+    The parameters of K replicas stacked into [K, ...] tensors, trained with one vectorized (`torch.func.vmap`)
+    forward / backward over the K batches and one optimizer. Adam is elementwise, so this is the same as K optimizers.
+    The first model is the template of the forward; `sync` copies the stacked parameters back into the models (e.g.,
+    before evaluating them).
+    """
+
+    def __init__(self, models, args, num_training_steps):
+        self.models = models
+        self.template = models[0]
+        self.params, self.buffers = torch.func.stack_module_state(models)
+
+        # Parameters that are not trained (fix_layers) do not need gradients
+        groups = group_parameters(self.params.items(), args.fix_layers, args.weight_decay)
+        trained = {id(p) for group in groups for p in group["params"]}
+        for p in self.params.values():
+            if id(p) not in trained:
+                p.requires_grad_(False)
+
+        self.optimizer = AdamW(groups, lr=args.learning_rate, betas=(args.adam_beta1, args.adam_beta2), eps=args.adam_epsilon)
+        self.scheduler = get_linear_schedule_with_warmup(self.optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=num_training_steps)
+        self.max_grad_norm = args.max_grad_norm
+
+        def compute_loss(params, buffers, inputs):
+            return torch.func.functional_call(self.template, (params, buffers), args=(), kwargs=inputs)[0]
+        # Dropout masks differ across the replicas
+        self.compute_loss = torch.func.vmap(compute_loss, randomness="different")
+
+    def training_step(self, batches, pad_token_id, gradient_accumulation_steps):
+        """
+        Forward / backward of the K batches; returns the K losses.
+        """
+        self.template.train()
+        inputs = stack_batches(batches, pad_token_id)
+        losses = self.compute_loss(self.params, self.buffers, inputs)
+        (losses.sum() / gradient_accumulation_steps).backward()
+        return losses.detach() / gradient_accumulation_steps
+
+    def optimizer_step(self):
+        """
+        Clip the gradients of each replica by its own norm, step, and return the K norms.
+        """
+        grads = [p.grad for p in self.params.values() if p.grad is not None]
+        norms = torch.stack([g.view(g.size(0), -1).norm(2, dim=1) for g in grads], 1).norm(2, dim=1)
+        clip_coef = (self.max_grad_norm / (norms + 1e-6)).clamp(max=1.0)
+        for g in grads:
+            g.mul_(clip_coef.view((-1,) + (1,) * (g.dim() - 1)))
+        self.optimizer.step()
+        self.scheduler.step()
+        self.optimizer.zero_grad()
+        return norms
+
+    def sync(self):
+        with torch.no_grad():
+            for k, model in enumerate(self.models):
+                for name, p in model.named_parameters():
+                    p.copy_(self.params[name][k])
+                for name, b in model.named_buffers():
+                    if name in self.buffers:
+                        b.copy_(self.buffers[name][k])
+
+
+def train_replicas(trainers, dev_objective=None):
+    """
+    Train the models of several trainers (replicas of one trial with different seeds and data splits) together, as
+    `Trainer.train` would train each of them: each replica has its own data order and demonstrations (drawn from the
+    global generators as seeded by its seed, see `GlobalRNGState`), optimizer state and best checkpoint (on its dev
+    set, every eval_steps). The replicas' forward / backward run as one batched computation (`StackedReplicas`),
+    which uses the cores much better than K runs on small batches. Without dropout, replica k gets the results of
+    `Trainer.train` with seed k (up to floating point rounding); with dropout, its masks are drawn differently.
+
+    Each trainer gets the state that `Trainer.train` leaves (objective, best_state, train_summary, ...), so it can be
+    evaluated and saved as usual. Returns the (TrainOutput, objective) of each trainer.
+    """
+    check_replicas(trainers)
+    args = trainers[0].args
+    dev_objective = dev_objective if dev_objective is not None else default_dev_objective
+    start_time = time.time()
+
+    dataloaders = []
+    rng_states = []
+    for trainer in trainers:
+        trainer.best_dir = None
+        trainer.objective = -float("inf")
+        trainer.dev_objective = dev_objective
+        trainer.best_state = None
+        trainer.checkpoint_writer = None
+        if getattr(trainer.args, "in_memory_checkpoint", False) and getattr(trainer.args, "persist_checkpoint", False):
+            trainer.checkpoint_writer = CheckpointWriter(trainer.model.config, trainer.args.output_dir, training_args=trainer.args)
+        # The generators as the trainer leaves them (it seeds them when it is built), when `Trainer.train` starts
+        set_seed(trainer.args.seed)
+        rng_states.append(GlobalRNGState())
+        dataloaders.append(trainer.get_train_dataloader())
+
+    num_update_steps_per_epoch = max(len(dataloaders[0]) // args.gradient_accumulation_steps, 1)
+    if args.max_steps > 0:
+        t_total = args.max_steps
+        num_train_epochs = args.max_steps // num_update_steps_per_epoch + int(args.max_steps % num_update_steps_per_epoch > 0)
+    else:
+        t_total = int(len(dataloaders[0]) // args.gradient_accumulation_steps * args.num_train_epochs)
+        num_train_epochs = args.num_train_epochs
+
+    models = [trainer.model for trainer in trainers]
+    replicas = StackedReplicas(models, args, t_total)
+    pad_token_id = models[0].tokenizer.pad_token_id if hasattr(models[0], "tokenizer") else 0
+
+    logger.info("***** Running training of %d replicas *****", len(trainers))
+    logger.info("  Num examples per replica = %d", len(trainers[0].train_dataset))
+    logger.info("  Num Epochs = %d", num_train_epochs)
+    logger.info("  Total optimization steps = %d", t_total)
+
+    global_step = 0
+    best_steps = [None] * len(trainers)
+    tr_loss = torch.zeros(len(trainers))
+    logging_loss = torch.zeros(len(trainers))
+    done = False
+    for epoch in range(int(num_train_epochs)):
+        num_batches = len(dataloaders[0])
+        iterators = []
+        for rng_state, dataloader in zip(rng_states, dataloaders):
+            with rng_state.active():
+                iterators.append(iter(dataloader))
+        for step in range(num_batches):
+            batches = []
+            for trainer, rng_state, iterator in zip(trainers, rng_states, iterators):
+                with rng_state.active():
+                    batches.append(trainer._prepare_inputs(next(iterator)))
+            tr_loss += replicas.training_step(batches, pad_token_id, args.gradient_accumulation_steps).cpu()
+
+            if (step + 1) % args.gradient_accumulation_steps != 0 and not (
+                num_batches <= args.gradient_accumulation_steps and (step + 1) == num_batches
+            ):
+                continue
+
+            norms = replicas.optimizer_step()
+            global_step += 1
+            for trainer in trainers:
+                trainer.global_step = global_step
+                trainer.epoch = epoch + (step + 1) / num_batches
+
+            if (args.logging_steps > 0 and global_step % args.logging_steps == 0) or (global_step == 1 and args.logging_first_step):
+                learning_rate = replicas.scheduler.get_last_lr()[0]
+                for k, trainer in enumerate(trainers):
+                    trainer.log({
+                        "loss": (tr_loss[k] - logging_loss[k]).item() / args.logging_steps,
+                        "norm": norms[k].item(),
+                        "learning_rate": learning_rate,
+                    })
+                logging_loss = tr_loss.clone()
+
+            if args.evaluate_during_training and global_step % args.eval_steps == 0:
+                replicas.sync()
+                for k, trainer in enumerate(trainers):
+                    with rng_states[k].active():
+                        output = trainer.evaluate()
+                    objective = dev_objective(output.metrics)
+                    if objective > trainer.objective:
+                        logger.info("Best dev result of replica {} (seed {}): {}".format(k, trainer.args.seed, objective))
+                        trainer.objective = objective
+                        best_steps[k] = global_step
+                        trainer.save_best()
+
+            if args.max_steps > 0 and global_step > args.max_steps:
+                done = True
+                break
+        if done:
+            break
+
+    replicas.sync()
+    for k, trainer in enumerate(trainers):
+        if best_steps[k] is None:
+            # Never evaluated (no evaluate_during_training): the last model is the checkpoint
+            trainer.save_best()
+    train_time = time.time() - start_time
+    logger.info("Trained %d replicas in %.1fs (%d steps)" % (len(trainers), train_time, global_step))
+
+    outputs = []
+    for k, trainer in enumerate(trainers):
+        trainer.train_summary = {
+            "stop_reason": None,
+            "stopped_step": global_step,
+            "best_step": best_steps[k],
+            "train_time": train_time,
+            "saved_steps": 0,
+            "saved_steps_ratio": 0.0,
+            "saved_time": 0.0,
+            "num_replicas": len(trainers),
+        }
+        outputs.append((TrainOutput(global_step, tr_loss[k].item() / max(global_step, 1)), trainer.objective))
+    return outputs
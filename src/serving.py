@@ -0,0 +1,234 @@
+"""Scoring new inputs with a trained prompt model (serving and batch prediction)."""
+
+import time
+import asyncio
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+from transformers import AutoConfig, AutoTokenizer
+
+from src.dataset import FewShotDataset, DynamicPaddingCollator, LengthBucketSampler
+from src.models import BertForPromptFinetuning, RobertaForPromptFinetuning
+from src.processors import output_modes_mapping, num_labels_mapping, bound_mapping
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def featurize_input(dataset, text_a, text_b, num_sample, seed):
+    """
+    Features of the num_sample samples of one input. Sample s always uses the demonstrations drawn from a generator
+    seeded by (seed, s), so that an input gets the same features every time (and in every process).
+    """
+    return [
+        dataset.convert_input(text_a, text_b, sample_idx=s, rng=np.random.RandomState([seed, s]))
+        for s in range(num_sample)
+    ]
+
+
+def featurize_inputs(dataset, inputs, num_sample, seed):
+    return [featurize_input(dataset, text_a, text_b, num_sample, seed) for text_a, text_b in inputs]
+
+
+# Featurization in worker processes (batch prediction): each worker gets a copy of the dataset once
+_worker_dataset = None
+
+
+def _init_featurize_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _featurize_inputs_in_worker(inputs, num_sample, seed):
+    return featurize_inputs(_worker_dataset, inputs, num_sample, seed)
+
+
+class PromptScorer:
+    """
+    Score raw inputs with a trained prompt model. Inputs are featurized by `FewShotDataset.convert_input` (template,
+    label words and demonstrations sampled from the training set, as in training), and the logits of the samples
+    (demonstration samples x templates) of an input are averaged, as in the evaluation of run.py.
+    """
+
+    def __init__(self, model, dataset, device, seed=42):
+        self.model = model
+        self.dataset = dataset
+        self.device = device
+        self.seed = seed
+        self.collator = DynamicPaddingCollator(dataset.tokenizer.pad_token_id)
+        self.is_regression = output_modes_mapping[dataset.args.task_name] == 'regression'
+
+        # Default number of samples (as for dev/test sets)
+        self.num_sample = dataset.args.num_sample if dataset.use_demo else 1
+        if dataset.args.template_list is not None:
+            self.num_sample *= len(dataset.args.template_list)
+
+    def featurize(self, text_a, text_b=None, num_sample=None):
+        """
+        Features of the samples of one input (see `featurize_input`).
+        """
+        num_sample = num_sample if num_sample is not None else self.num_sample
+        return featurize_input(self.dataset, text_a, text_b, num_sample, self.seed)
+
+    def score(self, features):
+        """
+        Logits (or, for regression, scores) of a batch of features, as a [num_features, num_logits] array.
+        """
+        batch = self.collator(features)
+        batch = {k: v.to(self.device) for k, v in batch.items()}
+        with torch.no_grad():
+            logits = self.model(**batch)[0]
+        return logits.float().cpu().numpy()
+
+    def score_bucketed(self, features, batch_size):
+        """
+        Logits of many features, in batches of similar lengths (longest first), returned in the order of features.
+        """
+        order = LengthBucketSampler([len(f.input_ids) for f in features]).order
+        logits = [None] * len(features)
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            for i, row in zip(indices, self.score([features[i] for i in indices])):
+                logits[i] = row
+        return np.stack(logits)
+
+    def aggregate(self, logits):
+        """
+        Prediction of one input from the logits of its samples.
+        """
+        logits = logits.mean(axis=0)
+        if self.is_regression:
+            return {'score': float(logits[0])}
+        probs = np.exp(logits - logits.max())
+        probs = probs / probs.sum()
+        return {
+            'label': self.dataset.label_list[int(probs.argmax())],
+            'probabilities': {label: float(p) for label, p in zip(self.dataset.label_list, probs)},
+            'logits': logits.tolist(),
+        }
+
+
+def load_scorer(model_args, data_args, device, seed=42):
+    """
+    Load a checkpoint saved by run.py (model_args.model_name_or_path) and its training set (data_args.data_dir,
+    the source of the demonstrations), as run.py does.
+    """
+    if 'prompt' not in model_args.few_shot_type:
+        raise NotImplementedError("Only prompt-based models can be served")
+    data_args.prompt = True
+
+    config = AutoConfig.from_pretrained(
+        model_args.config_name if model_args.config_name else model_args.model_name_or_path,
+        num_labels=num_labels_mapping[data_args.task_name],
+        finetuning_task=data_args.task_name,
+        cache_dir=model_args.cache_dir,
+    )
+    if config.model_type == 'roberta':
+        model_fn = RobertaForPromptFinetuning
+    elif config.model_type == 'bert':
+        model_fn = BertForPromptFinetuning
+    else:
+        raise NotImplementedError
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_args.tokenizer_name if model_args.tokenizer_name else model_args.model_name_or_path,
+        cache_dir=model_args.cache_dir,
+    )
+
+    # The training set provides the label words and the demonstrations
+    dataset = FewShotDataset(data_args, tokenizer=tokenizer, mode="train", use_demo=("demo" in model_args.few_shot_type), seed=seed)
+
+    model = model_fn.from_pretrained(model_args.model_name_or_path, config=config, cache_dir=model_args.cache_dir)
+    model = model.to(device)
+    model.eval()
+    model.label_word_list = torch.tensor(dataset.label_word_list).long().to(device)
+    if output_modes_mapping[data_args.task_name] == 'regression':
+        # lower / upper bounds
+        model.lb, model.ub = bound_mapping[data_args.task_name]
+    model.model_args = model_args
+    model.data_args = data_args
+    model.tokenizer = tokenizer
+
+    return PromptScorer(model, dataset, device, seed=seed)
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent scoring requests into micro-batches. A batch is run when it has max_batch_size features, or
+    max_latency seconds after its first feature arrived. The model runs in a separate thread, so the event loop keeps
+    accepting requests meanwhile.
+    """
+
+    def __init__(self, scorer, max_batch_size=32, max_latency=0.01):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # Metrics
+        self.num_requests = 0
+        self.num_features = 0
+        self.num_batches = 0
+        self.max_queue_depth = 0
+        self.batch_size_counts = {}
+        self.total_latency = 0.0
+
+    async def submit(self, features):
+        """
+        Score features (e.g., the samples of one input), and return their logits.
+        """
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        futures = []
+        for feature in features:
+            future = loop.create_future()
+            self.queue.put_nowait((feature, future))
+            futures.append(future)
+        self.num_requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        logits = np.stack(await asyncio.gather(*futures))
+        self.total_latency += time.time() - start
+        return logits
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.num_batches += 1
+            self.num_features += len(batch)
+            self.batch_size_counts[len(batch)] = self.batch_size_counts.get(len(batch), 0) + 1
+            features = [feature for feature, _ in batch]
+            try:
+                logits = await loop.run_in_executor(self.executor, self.scorer.score, features)
+            except Exception as e:
+                logger.exception("Scoring failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), row in zip(batch, logits):
+                if not future.done():
+                    future.set_result(row)
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'requests': self.num_requests,
+            'features': self.num_features,
+            'batches': self.num_batches,
+            'mean_batch_size': self.num_features / self.num_batches if self.num_batches > 0 else 0.0,
+            'batch_sizes': {str(k): v for k, v in sorted(self.batch_size_counts.items())},
+            'mean_request_latency': self.total_latency / self.num_requests if self.num_requests > 0 else 0.0,
+        }
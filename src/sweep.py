@@ -0,0 +1,195 @@
+"""Running many trials (hyper-parameter / seed / template sweeps) in one process."""
+
+import os
+import re
+import glob
+import json
+import hashlib
+import itertools
+import numpy as np
+import torch
+from collections import OrderedDict
+
+from filelock import FileLock
+from transformers import AutoTokenizer
+from transformers.file_utils import WEIGHTS_NAME, hf_bucket_url, cached_path
+
+from src.dataset import FewShotDataset
+from src.feature_cache import featurization_key
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def expand_grid(spec):
+    """
+    Trials (dicts of arguments of run.py) of a sweep spec:
+        {"base": {...}, "grid": {"learning_rate": [1e-5, 2e-5], "seed": [13, 21], "task": [{...}, {...}]}}
+    Every combination of the grid values is a trial, on top of the base arguments. A grid value that is a dict sets
+    several arguments at once (e.g., a task with its template and mapping). In string arguments, {name} is replaced
+    by the trial's argument name, e.g., "data_dir": "data/k-shot/{task_name}/16-{seed}".
+    """
+    base = spec.get("base", {})
+    grid = spec.get("grid", {})
+    names = list(grid.keys())
+    trials = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        trial = dict(base)
+        for name, value in zip(names, values):
+            if isinstance(value, dict):
+                trial.update(value)
+            else:
+                trial[name] = value
+        fill = lambda m: str(trial[m.group(1)]) if m.group(1) in trial else m.group(0)
+        trial = {k: re.sub(r"\{(\w+)\}", fill, v) if isinstance(v, str) else v for k, v in trial.items()}
+        trials.append(trial)
+    return trials
+
+
+# Arguments in which replicas (trials trained together, see `src.replicas`) may differ
+REPLICA_ARGUMENTS = ["seed", "data_dir", "output_dir"]
+
+
+def replica_groups(trials, max_replicas):
+    """
+    Group the trials that only differ by REPLICA_ARGUMENTS (e.g., the data seeds of one configuration), in groups of
+    at most max_replicas, keeping the order of the sweep.
+    """
+    groups = OrderedDict()
+    for trial in trials:
+        key = json.dumps({k: v for k, v in trial.items() if k not in REPLICA_ARGUMENTS}, sort_keys=True)
+        groups.setdefault(key, []).append(trial)
+    return [group[i:i + max_replicas] for group in groups.values() for i in range(0, len(group), max_replicas)]
+
+
+def load_sweep_spec(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def trial_key(trial):
+    """
+    Identifier of a trial (its arguments), recorded in the log so that a resumed sweep can skip the trial.
+    """
+    return hashlib.sha1(json.dumps(trial, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_log(log_file):
+    """
+    Results in a log written by run.py (one dict per line, as read by tools/gather_result.py).
+    """
+    results = []
+    if not os.path.exists(log_file):
+        return results
+    with open(log_file) as f:
+        for line in f:
+            if line.strip():
+                try:
+                    results.append(eval(line, {"device": torch.device, "np": np}))
+                except Exception:
+                    logger.warning("Cannot parse a line of {}".format(log_file))
+    return results
+
+
+def completed_trial_keys(log_file):
+    return {result['sweep_trial_key'] for result in read_log(log_file) if 'sweep_trial_key' in result}
+
+
+def log_shard_files(log_file):
+    return sorted(glob.glob(log_file + ".shard-*[0-9]"))
+
+
+def merge_log_shards(log_file):
+    """
+    Append the per-worker logs (log_file.shard-*) to log_file and remove them.
+    """
+    shards = log_shard_files(log_file)
+    if len(shards) == 0:
+        return
+    with FileLock(log_file + '.lock'):
+        with open(log_file, 'a') as f:
+            for shard in shards:
+                with open(shard) as g:
+                    f.write(g.read())
+                os.remove(shard)
+                if os.path.exists(shard + '.lock'):
+                    os.remove(shard + '.lock')
+    logger.info("Merged {} log shards into {}".format(len(shards), log_file))
+
+
+def checkpoint_state_dict(model_name_or_path, cache_dir=None):
+    """
+    The weights that `from_pretrained` would load (a local directory or a model on the hub), read once.
+    """
+    if os.path.isdir(model_name_or_path):
+        archive_file = os.path.join(model_name_or_path, WEIGHTS_NAME)
+    elif os.path.isfile(model_name_or_path):
+        archive_file = model_name_or_path
+    else:
+        archive_file = cached_path(hf_bucket_url(model_name_or_path, filename=WEIGHTS_NAME), cache_dir=cache_dir)
+    return torch.load(archive_file, map_location="cpu")
+
+
+class TrialResources:
+    """
+    What run.py loads for a trial: the tokenizer, the pretrained weights and the datasets. With share, they are
+    kept for the next trials of the process:
+        - tokenizers by name;
+        - the pretrained weights as a pristine state dict in shared memory; each trial builds its model from it
+          with `from_pretrained(state_dict=...)`, so the model is the same (including the randomly initialized
+          weights, for a given seed) as when loading from disk;
+        - datasets by their featurization config (see `featurization_key`) and data directory (the max_datasets
+          most recently used ones).
+    Without share, everything is loaded for the trial only (a single run of run.py).
+    """
+
+    def __init__(self, share=True, max_datasets=32):
+        self.share = share
+        self.max_datasets = max_datasets
+        self.tokenizers = {}
+        self.checkpoints = {}
+        self.datasets = OrderedDict()
+
+    def tokenizer(self, name, cache_dir=None, additional_special_tokens=None):
+        key = (name, cache_dir)
+        if not self.share or key not in self.tokenizers:
+            tokenizer = AutoTokenizer.from_pretrained(name, additional_special_tokens=additional_special_tokens, cache_dir=cache_dir)
+            if not self.share:
+                return tokenizer
+            self.tokenizers[key] = tokenizer
+        return self.tokenizers[key]
+
+    def pretrained_model(self, model_fn, model_name_or_path, config, cache_dir=None):
+        from_tf = bool(".ckpt" in model_name_or_path)
+        if not self.share or from_tf:
+            return model_fn.from_pretrained(model_name_or_path, from_tf=from_tf, config=config, cache_dir=cache_dir)
+
+        # Parameters are copied from the state dict, which stays pristine
+        return model_fn.from_pretrained(None, config=config, state_dict=self.pretrained_state_dict(model_name_or_path, cache_dir))
+
+    def pretrained_state_dict(self, model_name_or_path, cache_dir=None):
+        key = (model_name_or_path, cache_dir)
+        if key not in self.checkpoints:
+            state_dict = checkpoint_state_dict(model_name_or_path, cache_dir=cache_dir)
+            for tensor in state_dict.values():
+                tensor.share_memory_()
+            self.checkpoints[key] = state_dict
+        return self.checkpoints[key]
+
+    def dataset(self, data_args, tokenizer, mode, use_demo, seed):
+        if not self.share:
+            return FewShotDataset(data_args, tokenizer=tokenizer, mode=mode, use_demo=use_demo, seed=seed)
+
+        key = (
+            os.path.abspath(data_args.data_dir),
+            id(tokenizer),
+            featurization_key(data_args, tokenizer, mode, use_demo, data_args.num_sample, seed),
+        )
+        if key not in self.datasets:
+            self.datasets[key] = FewShotDataset(data_args, tokenizer=tokenizer, mode=mode, use_demo=use_demo, seed=seed)
+            while len(self.datasets) > self.max_datasets:
+                self.datasets.popitem(last=False)
+        else:
+            logger.info("Reuse the {} dataset of a previous trial".format(mode))
+            self.datasets.move_to_end(key)
+        return self.datasets[key]
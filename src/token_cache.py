@@ -0,0 +1,120 @@
+"""Token id cache shared by all the featurization of a process."""
+
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def transform_sentence(text, variant):
+    """
+    Apply the sentence transform of a template variable (e.g., the "+l" in *+sentl_1*) to the raw text.
+        +: add a space before the sentence
+        l / u: lower / upper case the first character
+        -: delete the last character
+    """
+    if 'l' in variant:
+        text = text[:1].lower() + text[1:]
+    elif 'u' in variant:
+        text = text[:1].upper() + text[1:]
+    if '-' in variant:
+        text = text[:-1]
+    if '+' in variant:
+        text = ' ' + text
+    return text
+
+
+class TokenCache:
+    """
+    Bounded LRU cache mapping (text, variant) to the token ids of the transformed text.
+
+    With demonstrations, the same support sentences are encoded again for every query and for every sample,
+    so each distinct sentence variant should only hit the tokenizer once per process.
+    """
+
+    def __init__(self, tokenizer, max_entries=1000000, max_bytes=1 << 30):
+        # Weak reference, so that the cache (kept in `_token_caches`) does not keep the tokenizer alive
+        self.tokenizer_ref = weakref.ref(tokenizer)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def encode(self, text, variant=''):
+        """
+        Return the token ids (a tuple) of `transform_sentence(text, variant)`, without special tokens.
+        """
+        key = (text, variant)
+        with self.lock:
+            ids = self.entries.get(key)
+            if ids is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return ids
+            self.misses += 1
+
+        ids = tuple(self.tokenizer_ref().encode(transform_sentence(text, variant), add_special_tokens=False))
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = ids
+                self.nbytes += self._entry_size(key, ids)
+                self._evict()
+        return ids
+
+    def resize(self, max_entries=None, max_bytes=None):
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+        }
+
+    def _evict(self):
+        while len(self.entries) > 0 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+            key, ids = self.entries.popitem(last=False)
+            self.nbytes -= self._entry_size(key, ids)
+
+    @staticmethod
+    def _entry_size(key, ids):
+        # Approximate memory of the key strings and the id tuple (28 bytes per int object)
+        return sys.getsizeof(key[0]) + sys.getsizeof(key[1]) + sys.getsizeof(ids) + 28 * len(ids)
+
+
+_token_caches = weakref.WeakKeyDictionary()
+_token_caches_lock = threading.Lock()
+
+
+def get_token_cache(tokenizer):
+    """
+    Get the token cache of a tokenizer (one cache per tokenizer object).
+    """
+    with _token_caches_lock:
+        cache = _token_caches.get(tokenizer)
+        if cache is None:
+            cache = TokenCache(tokenizer)
+            _token_caches[tokenizer] = cache
+    return cache
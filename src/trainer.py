@@ -24,6 +24,7 @@ import math
 import os
 import re
 import shutil
+import time
 import warnings
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
@@ -152,6 +153,11 @@ logger = logging.get_logger(__name__)
 
 ########## The above part is copied from Transformers' trainer (3.4.0) ########## 
 
+from src.dataset import LengthBucketSampler
+from src.models import FrozenLayerCache
+from src.checkpoint import snapshot_state_dict, CheckpointWriter
+from src.profiling import StepProfiler
+
 def default_dev_objective(metrics):
     """
     Objective used for picking the best model on development sets
@@ -171,49 +177,62 @@ def default_dev_objective(metrics):
  
     raise Exception("No metric founded for {}".format(metrics))
 
+def group_parameters(named_parameters, fix_layers, weight_decay):
+    """
+    Parameter groups of the optimizer: with fix_layers > 0, the embeddings and the bottom fix_layers layers are left
+    out, and biases and LayerNorm weights get no weight decay.
+    """
+    params = {}
+    for n, p in named_parameters:
+        if fix_layers > 0:
+            if 'encoder.layer' in n:
+                try:
+                    layer_num = int(n[n.find('encoder.layer') + 14:].split('.')[0])
+                except:
+                    print(n)
+                    raise Exception("")
+                if layer_num >= fix_layers:
+                    print('yes', n)
+                    params[n] = p
+                else:
+                    print('no ', n)
+            elif 'embeddings' in n:
+                print('no ', n)
+            else:
+                print('yes', n)
+                params[n] = p
+        else:
+            params[n] = p
+    no_decay = ["bias", "LayerNorm.weight"]
+    return [
+        {
+            "params": [p for n, p in params.items() if not any(nd in n for nd in no_decay)],
+            "weight_decay": weight_decay,
+        },
+        {
+            "params": [p for n, p in params.items() if any(nd in n for nd in no_decay)],
+            "weight_decay": 0.0,
+        },
+    ]
+
+
 class Trainer(transformers.Trainer):
     """
     Adding some functions based on Transformers' Trainer class.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Replaced in train (disabled, it only counts the examples and tokens)
+        self.profiler = StepProfiler()
+
     def create_optimizer_and_scheduler(self, num_training_steps: int):
         """
         Based on Transformers' default one, we add fixing layer option where the bottom n layers' parameters
         are fixed and only the top layers are further fine-tuned.
         """
         if self.optimizer is None:
-            params = {}
-            for n, p in self.model.named_parameters():
-                if self.args.fix_layers > 0:
-                    if 'encoder.layer' in n:
-                        try:
-                            layer_num = int(n[n.find('encoder.layer') + 14:].split('.')[0])
-                        except:
-                            print(n)
-                            raise Exception("")
-                        if layer_num >= self.args.fix_layers:
-                            print('yes', n)
-                            params[n] = p
-                        else:
-                            print('no ', n)
-                    elif 'embeddings' in n:
-                        print('no ', n)
-                    else:
-                        print('yes', n)
-                        params[n] = p
-                else:
-                    params[n] = p
-            no_decay = ["bias", "LayerNorm.weight"]
-            optimizer_grouped_parameters = [
-                {
-                    "params": [p for n, p in params.items() if not any(nd in n for nd in no_decay)],
-                    "weight_decay": self.args.weight_decay,
-                },
-                {
-                    "params": [p for n, p in params.items() if any(nd in n for nd in no_decay)],
-                    "weight_decay": 0.0,
-                },
-            ]
+            optimizer_grouped_parameters = group_parameters(self.model.named_parameters(), self.args.fix_layers, self.args.weight_decay)
             self.optimizer = AdamW(
                 optimizer_grouped_parameters,
                 lr=self.args.learning_rate,
@@ -236,8 +255,37 @@ class Trainer(transformers.Trainer):
         self.objective = -float("inf")
         self.dev_objective = dev_objective if dev_objective is not None else default_dev_objective
 
+        # Early stopping: stop after `patience` evaluations without an improvement of more than `min_delta`, or
+        # when the time budget (seconds) is used up
+        patience = getattr(self.args, "early_stopping_patience", 0)
+        min_delta = getattr(self.args, "early_stopping_min_delta", 0.0)
+        time_budget = getattr(self.args, "time_budget", 0)
+        num_bad_evals = 0
+        stop_reason = None
+        best_step = None
+        start_time = time.time()
+
+        # With profile, the phases of the steps are timed (and traced with profile_trace)
+        profile_trace = getattr(self.args, "profile_trace", None)
+        profile = getattr(self.args, "profile", False) or profile_trace is not None
+        self.profiler = StepProfiler(
+            enabled=profile,
+            trace=profile_trace is not None,
+            synchronize=profile and self.args.device.type == "cuda",
+        )
+
+        # With in_memory_checkpoint, the best model is kept as a CPU snapshot (and written to disk in the background
+        # with persist_checkpoint) instead of being saved synchronously
+        self.best_state = None
+        self.checkpoint_writer = None
+        if getattr(self.args, "in_memory_checkpoint", False) and getattr(self.args, "persist_checkpoint", False) and self.is_world_master():
+            self.checkpoint_writer = CheckpointWriter(self.model.config, self.args.output_dir, training_args=self.args)
+
         # Data loading.
         train_dataloader = self.get_train_dataloader()
+        if profile and isinstance(train_dataloader, DataLoader):
+            # Only timed in this process (dataloader_num_workers=0); otherwise collate is part of the data wait
+            train_dataloader.collate_fn = self.profiler.wrap(train_dataloader.collate_fn, "collate")
         num_update_steps_per_epoch = len(train_dataloader) // self.args.gradient_accumulation_steps 
         if num_update_steps_per_epoch == 0:
             num_update_steps_per_epoch = 1
@@ -268,6 +316,13 @@ class Trainer(transformers.Trainer):
 
         model = self.model
 
+        # With fix_layers, the outputs of the frozen layers can be cached (only if the training inputs do not change)
+        if getattr(self.args, "cache_frozen_layers", False) and self.args.fix_layers > 0 and hasattr(model, "frozen_layer_cache"):
+            if getattr(self.train_dataset, "use_demo", False):
+                logger.info("Demonstrations are sampled online, so the frozen layers are not cached")
+            else:
+                model.frozen_layer_cache = FrozenLayerCache(self.args.fix_layers, max_entries=len(self.train_dataset))
+
         if self.args.fp16 and _use_apex:
             if not transformers.is_apex_available():
                 raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
@@ -347,13 +402,14 @@ class Trainer(transformers.Trainer):
             if self.args.past_index >= 0:
                 self._past = None
 
-            for step, inputs in enumerate(epoch_iterator):
+            for step, inputs in enumerate(self.profiler.iterate(epoch_iterator, "data")):
 
                 # Skip past any already trained steps if resuming training
                 if steps_trained_in_current_epoch > 0:
                     steps_trained_in_current_epoch -= 1
                     continue
 
+                self.profiler.count_batch(inputs)
                 tr_loss += self.training_step(model, inputs)
 
                 if (step + 1) % self.args.gradient_accumulation_steps == 0 or (
@@ -361,24 +417,25 @@ class Trainer(transformers.Trainer):
                     len(epoch_iterator) <= self.args.gradient_accumulation_steps
                     and (step + 1) == len(epoch_iterator)
                 ):
-                    if self.args.fp16 and _use_native_amp:
-                        self.scaler.unscale_(optimizer)
-                        norm = torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
-                    elif self.args.fp16:
-                        norm = torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), self.args.max_grad_norm)
-                    else:
-                        norm = torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
-
-                    if transformers.is_torch_tpu_available():
-                        xm.optimizer_step(optimizer)
-                    elif self.args.fp16 and _use_native_amp:
-                        self.scaler.step(optimizer)
-                        self.scaler.update()
-                    else:
-                        optimizer.step()
-
-                    scheduler.step()
-                    model.zero_grad()
+                    with self.profiler.span("optimizer"):
+                        if self.args.fp16 and _use_native_amp:
+                            self.scaler.unscale_(optimizer)
+                            norm = torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
+                        elif self.args.fp16:
+                            norm = torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), self.args.max_grad_norm)
+                        else:
+                            norm = torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
+
+                        if transformers.is_torch_tpu_available():
+                            xm.optimizer_step(optimizer)
+                        elif self.args.fp16 and _use_native_amp:
+                            self.scaler.step(optimizer)
+                            self.scaler.update()
+                        else:
+                            optimizer.step()
+
+                        scheduler.step()
+                        model.zero_grad()
                     self.global_step += 1
                     self.epoch = epoch + (step + 1) / len(epoch_iterator)
 
@@ -396,6 +453,8 @@ class Trainer(transformers.Trainer):
                             else scheduler.get_lr()[0]
                         )
                         logging_loss_scalar = tr_loss_scalar
+                        # Examples / s, tokens / s (without padding) and peak memory since the last log
+                        logs.update(self.profiler.throughput(self.args.device))
 
                         self.log(logs)
 
@@ -403,31 +462,81 @@ class Trainer(transformers.Trainer):
                     # BEGIN CHANGES.
                     # ----------------------------------------------------------------------
 
+                    # When the time budget is used up, the last model is evaluated before stopping (so that there is
+                    # always a checkpoint, even if the budget ends before the first evaluation)
+                    out_of_time = time_budget > 0 and time.time() - start_time > time_budget
                     metrics = None
-                    if self.args.evaluate_during_training and self.global_step % self.args.eval_steps == 0:
-                        output = self.evaluate()
+                    if self.args.evaluate_during_training and (self.global_step % self.args.eval_steps == 0 or out_of_time):
+                        with self.profiler.span("eval"):
+                            output = self.evaluate()
                         metrics = output.metrics
                         objective = self.dev_objective(metrics)
+                        if objective > self.objective + min_delta:
+                            num_bad_evals = 0
+                        else:
+                            num_bad_evals += 1
                         if objective > self.objective:
                             logger.info("Best dev result: {}".format(objective))
                             self.objective = objective
-                            self.save_model(self.args.output_dir) 
+                            best_step = self.global_step
+                            self.save_best()
+                        if patience > 0 and num_bad_evals >= patience:
+                            stop_reason = "patience"
+                            logger.info("Early stopping at step %d: no improvement in %d evaluations" % (self.global_step, num_bad_evals))
+
+                    if stop_reason is None and out_of_time:
+                        stop_reason = "time_budget"
+                        logger.info("Early stopping at step %d: time budget of %ds used up" % (self.global_step, time_budget))
 
                     # ----------------------------------------------------------------------
                     # END CHANGES.
                     # ----------------------------------------------------------------------
 
 
-                if self.args.max_steps > 0 and self.global_step > self.args.max_steps:
+                if (self.args.max_steps > 0 and self.global_step > self.args.max_steps) or stop_reason is not None:
                     epoch_iterator.close()
                     break
-            if self.args.max_steps > 0 and self.global_step > self.args.max_steps:
+            if (self.args.max_steps > 0 and self.global_step > self.args.max_steps) or stop_reason is not None:
                 train_iterator.close()
                 break
             if self.args.tpu_metrics_debug or self.args.debug:
                 # tpu-comment: Logging debug metrics for PyTorch/XLA (compile, execute times, ops, etc.)
                 xm.master_print(met.metrics_report())
 
+        if best_step is None:
+            # Never evaluated (no evaluate_during_training): the last model is the checkpoint
+            logger.warning("No evaluation during training, keep the last model (step %d) as the checkpoint" % self.global_step)
+            self.save_best()
+
+        # What early stopping saved, for the log
+        train_time = time.time() - start_time
+        saved_steps = max(t_total - self.global_step, 0) if stop_reason is not None else 0
+        self.train_summary = {
+            "stop_reason": stop_reason,
+            "stopped_step": self.global_step,
+            "best_step": best_step,
+            "train_time": train_time,
+            "saved_steps": saved_steps,
+            "saved_steps_ratio": saved_steps / t_total if t_total > 0 else 0.0,
+            # Assuming the remaining steps would have taken as long as the completed ones
+            "saved_time": saved_steps * train_time / max(self.global_step, 1),
+        }
+        if stop_reason is not None:
+            logger.info("Stopped at step %d of %d (%s), saved %d steps (%.1f%%)" % (
+                self.global_step, t_total, stop_reason, saved_steps, 100 * self.train_summary["saved_steps_ratio"]))
+
+        # Throughput, and where the time went (profile)
+        self.train_summary.update(self.profiler.summary(train_time, self.args.device))
+        if profile:
+            logger.info("Training time by phase:\n" + self.profiler.table(train_time))
+        if profile_trace is not None:
+            self.profiler.export_chrome_trace(profile_trace)
+
+        if getattr(self.model, "frozen_layer_cache", None) is not None:
+            cache = self.model.frozen_layer_cache
+            logger.info("Frozen layer cache: %d entries, %d hits, %d misses" % (len(cache.entries), cache.hits, cache.misses))
+            self.model.frozen_layer_cache = None
+
         if self.args.past_index and hasattr(self, "_past"):
             # Clean the state at the end of training
             delattr(self, "_past")
@@ -436,6 +545,115 @@ class Trainer(transformers.Trainer):
         return TrainOutput(self.global_step, tr_loss / self.global_step), self.objective
 
 
+    def training_step(self, model, inputs):
+        """
+        Same as the original training step, with the forward and the backward timed separately (profile).
+        """
+        model.train()
+        inputs = self._prepare_inputs(inputs)
+
+        with self.profiler.span("forward"):
+            if self.args.fp16 and _use_native_amp:
+                with autocast():
+                    loss = self.compute_loss(model, inputs)
+            else:
+                loss = self.compute_loss(model, inputs)
+
+            if self.args.n_gpu > 1:
+                loss = loss.mean()  # mean() to average on multi-gpu parallel training
+
+            if self.args.gradient_accumulation_steps > 1:
+                loss = loss / self.args.gradient_accumulation_steps
+
+        with self.profiler.span("backward"):
+            if self.args.fp16 and _use_native_amp:
+                self.scaler.scale(loss).backward()
+            elif self.args.fp16 and _use_apex:
+                with amp.scale_loss(loss, self.optimizer) as scaled_loss:
+                    scaled_loss.backward()
+            else:
+                loss.backward()
+
+        return loss.detach()
+
+    def save_best(self):
+        """
+        Checkpoint the current model as the best one: an in-memory snapshot (in_memory_checkpoint, also written in the
+        background with persist_checkpoint) or a checkpoint in output_dir.
+        """
+        with self.profiler.span("save"):
+            if getattr(self.args, "in_memory_checkpoint", False):
+                self.best_state = snapshot_state_dict(self.model)
+                if self.checkpoint_writer is not None:
+                    self.checkpoint_writer.submit(self.best_state, step=self.global_step)
+            else:
+                self.save_model(self.args.output_dir)
+
+    def restore_best(self):
+        """
+        Load the best in-memory snapshot (in_memory_checkpoint) into the model, in place.
+        """
+        if self.best_state is None:
+            logger.warning("No in-memory checkpoint (the dev objective never improved), keep the last model")
+            return
+        self.model.load_state_dict(self.best_state)
+
+    def finish_checkpoint(self):
+        """
+        Wait for the background writer (persist_checkpoint) to write the latest snapshot.
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            self.checkpoint_writer = None
+
+    def _get_eval_sampler(self, eval_dataset):
+        """
+        With eval_length_bucketing, visit the (pre-processed) evaluation examples by length, so that
+        dynamically padded batches contain sequences of similar lengths.
+        """
+        if (
+            getattr(self.args, "eval_length_bucketing", False)
+            and self.args.local_rank == -1
+            and not is_torch_tpu_available()
+            and getattr(eval_dataset, "features", None) is not None
+        ):
+            return LengthBucketSampler(eval_dataset.get_lengths())
+        return super()._get_eval_sampler(eval_dataset)
+
+    def prediction_loop(self, dataloader, description, prediction_loss_only=None):
+        """
+        Same as the original prediction loop, but when the examples are visited by length (`LengthBucketSampler`),
+        put the predictions back into the dataset order before computing the metrics (the metrics rely on
+        the order to average over samples).
+        """
+        sampler = getattr(dataloader, "sampler", None)
+        if not isinstance(sampler, LengthBucketSampler):
+            return super().prediction_loop(dataloader, description, prediction_loss_only=prediction_loss_only)
+
+        compute_metrics = self.compute_metrics
+        self.compute_metrics = None
+        try:
+            output = super().prediction_loop(dataloader, description, prediction_loss_only=prediction_loss_only)
+        finally:
+            self.compute_metrics = compute_metrics
+
+        inverse = np.argsort(sampler.order)
+        def reorder(x):
+            if x is None:
+                return None
+            if isinstance(x, (list, tuple)):
+                return type(x)(reorder(t) for t in x)
+            return x[inverse]
+        predictions = reorder(output.predictions)
+        label_ids = reorder(output.label_ids)
+
+        metrics = output.metrics
+        if compute_metrics is not None and predictions is not None and label_ids is not None:
+            for key, value in compute_metrics(EvalPrediction(predictions=predictions, label_ids=label_ids)).items():
+                metrics[key if key.startswith("eval_") else f"eval_{key}"] = value
+
+        return PredictionOutput(predictions=predictions, label_ids=label_ids, metrics=metrics)
+
     """
     Difference compared to original implementation: return output instead of output.metrics (so there is also the logits)
     """
@@ -0,0 +1,102 @@
+"""Shared fixtures: a tiny BERT checkpoint and few-shot SST-2 style data, small enough to train on CPU in seconds."""
+
+import os
+import sys
+import json
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import BertConfig
+
+from run import ModelArguments, DynamicDataTrainingArguments, DynamicTrainingArguments
+from src.models import BertForPromptFinetuning
+
+WORDS = 'good bad movie plot actor great terrible fun boring scene music'.split()
+SEEDS = [13, 21]
+
+
+@pytest.fixture(scope="session")
+def tiny_bert(tmp_path_factory):
+    """
+    A randomly initialized 2-layer BERT with its tokenizer files. Dropout is off, so that training only depends on
+    the seeds of the data order and of the demonstrations.
+    """
+    # Named like the pretrained models: `Trainer.train` reads a path ending in -<number> (e.g., .../pytest-3/bert0)
+    # as a checkpoint to resume from
+    path = str(tmp_path_factory.mktemp("bert-tiny"))
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS + ['it', 'was', '.', '*']
+    with open(os.path.join(path, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(vocab) + '\n')
+    with open(os.path.join(path, 'tokenizer_config.json'), 'w') as f:
+        json.dump({'do_lower_case': True, 'model_max_length': 128}, f)
+    config = BertConfig(
+        vocab_size=len(vocab), hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64,
+        max_position_embeddings=128, hidden_dropout_prob=0.0, attention_probs_dropout_prob=0.0,
+    )
+    torch.manual_seed(0)
+    BertForPromptFinetuning(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def few_shot_data(tmp_path_factory):
+    """
+    One data split per seed (data/<seed>/{train,dev,test}.tsv), as in data/k-shot.
+    """
+    root = str(tmp_path_factory.mktemp("data"))
+    rng = np.random.RandomState(0)
+    for seed in SEEDS:
+        data_dir = os.path.join(root, str(seed))
+        os.makedirs(data_dir)
+        for split, size in [('train', 16), ('dev', 16), ('test', 24)]:
+            with open(os.path.join(data_dir, split + '.tsv'), 'w') as f:
+                f.write('sentence\tlabel\n')
+                for i in range(size):
+                    f.write(' '.join(rng.choice(WORDS, rng.randint(2, 10))) + '\t' + str(i % 2) + '\n')
+    return root
+
+
+def trial_arguments(model_dir, data_root, output_dir, seed, few_shot_type='prompt', **training):
+    """
+    The (model_args, data_args, training_args) of a short training run.
+    """
+    model_args = ModelArguments(model_name_or_path=model_dir, few_shot_type=few_shot_type)
+    data_args = DynamicDataTrainingArguments(
+        task_name='sst-2',
+        data_dir=os.path.join(data_root, str(seed)),
+        template='*cls**sent_0*_it_was*mask*.*sep+*',
+        mapping="{'0':'bad','1':'good'}",
+        num_sample=2,
+        max_seq_length=64,
+    )
+    training = dict(dict(
+        output_dir=output_dir,
+        seed=seed,
+        do_train=True,
+        do_eval=True,
+        do_predict=True,
+        evaluate_during_training=True,
+        max_steps=8,
+        eval_steps=4,
+        logging_steps=4,
+        per_device_train_batch_size=4,
+        learning_rate=1e-3,
+        num_train_epochs=0,
+        no_cuda=True,
+        overwrite_output_dir=True,
+    ), **training)
+    return model_args, data_args, DynamicTrainingArguments(**training)
+
+
+@pytest.fixture
+def make_trial(tiny_bert, few_shot_data, tmp_path):
+    """
+    make_trial(seed, name=None, **training_args): the arguments of a trial writing to tmp_path/<name or seed>.
+    """
+    def make(seed, name=None, **training):
+        return trial_arguments(tiny_bert, few_shot_data, str(tmp_path / (name or str(seed))), seed, **training)
+    return make
@@ -0,0 +1,25 @@
+import pytest
+
+from run import run, run_replicas
+from src.sweep import TrialResources, read_log
+
+METRICS = ['sst-2_dev_eval_acc', 'sst-2_test_eval_acc', 'sst-2_dev_eval_loss', 'sst-2_test_eval_loss', 'best_step']
+
+
+def test_replicas_match_seeded_runs(make_trial, tmp_path):
+    # Replica k samples its demonstrations and shuffles its data from seed k, whatever the other replicas draw,
+    # so (without dropout) it gets the results of the standalone run with seed k
+    seeds = [13, 21]
+    log_file = str(tmp_path / 'log-replicas')
+    run_replicas([make_trial(seed, few_shot_type='prompt-demo') for seed in seeds], log_files=[log_file] * len(seeds))
+
+    alone_log_file = str(tmp_path / 'log-alone')
+    for seed in seeds:
+        run(*make_trial(seed, name='%d-alone' % seed, few_shot_type='prompt-demo'), resources=TrialResources(share=False), log_file=alone_log_file)
+
+    replicas, alone = read_log(log_file), read_log(alone_log_file)
+    assert [result['seed'] for result in replicas] == seeds
+    for replica, result in zip(replicas, alone):
+        assert replica['num_replicas'] == len(seeds)
+        for key in METRICS:
+            assert replica[key] == pytest.approx(result[key], abs=1e-4), key
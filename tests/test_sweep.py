@@ -0,0 +1,22 @@
+from run import run
+from src.sweep import TrialResources, read_log
+
+
+def dev_results(log_file):
+    return [{k: v for k, v in result.items() if k.startswith('sst-2_dev_eval_') and 'runtime' not in k and 'per_second' not in k}
+            for result in read_log(log_file)]
+
+
+def test_trials_in_one_process(make_trial, tmp_path):
+    # Several trials in one process (as tools/sweep.py runs them), with thread settings that can only be applied
+    # once per process
+    log_file = str(tmp_path / 'log')
+    resources = TrialResources(share=True)
+    for seed in [13, 21]:
+        run(*make_trial(seed, inter_op_threads=1, intra_op_threads=1), resources=resources, log_file=log_file)
+    assert [result['seed'] for result in read_log(log_file)] == [13, 21]
+
+    # Sharing the tokenizer, the pretrained weights and the datasets does not change the results
+    alone_log_file = str(tmp_path / 'log-alone')
+    run(*make_trial(21, name='21-alone'), resources=TrialResources(share=False), log_file=alone_log_file)
+    assert dev_results(log_file)[1] == dev_results(alone_log_file)[0]
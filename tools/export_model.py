@@ -0,0 +1,203 @@
+"""Export a prompt-based fine-tuned model (saved by run.py) to TorchScript or ONNX."""
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import argparse
+import json
+import logging
+import torch
+import torch.nn as nn
+
+from transformers import AutoConfig, AutoTokenizer
+
+from src.dataset import map_label_words
+from src.models import BertForPromptFinetuning, RobertaForPromptFinetuning
+from src.processors import processors_mapping, num_labels_mapping, output_modes_mapping, bound_mapping
+
+logger = logging.getLogger(__name__)
+
+
+class PromptModelForExport(nn.Module):
+    """
+    Wrap a prompt model so that it takes tensors only (input_ids, attention_mask, mask_pos and, for BERT,
+    token_type_ids) and returns the label logits (or, for regression, the rescaled score). The mask gather, the
+    label word gather and the lb/ub rescaling are all part of the model's forward, so they end up in the graph.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.use_token_type_ids = isinstance(model, BertForPromptFinetuning)
+
+    def forward(self, input_ids, attention_mask, mask_pos, token_type_ids=None):
+        if self.use_token_type_ids:
+            return self.model(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids, mask_pos=mask_pos)[0]
+        return self.model(input_ids, attention_mask=attention_mask, mask_pos=mask_pos)[0]
+
+
+def load_prompt_model(model_dir, task_name, mapping, tokenizer_name=None, torchscript=False):
+    """
+    Load a checkpoint saved by run.py and set up the label words and (for regression) the bounds, as run.py does.
+    """
+    config = AutoConfig.from_pretrained(
+        model_dir,
+        num_labels=num_labels_mapping[task_name],
+        finetuning_task=task_name,
+        torchscript=torchscript,
+    )
+    if config.model_type == 'roberta':
+        model_fn = RobertaForPromptFinetuning
+    elif config.model_type == 'bert':
+        model_fn = BertForPromptFinetuning
+    else:
+        raise NotImplementedError
+    model = model_fn.from_pretrained(model_dir, config=config)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name if tokenizer_name is not None else model_dir)
+
+    label_list = processors_mapping[task_name].get_labels()
+    _, label_word_list = map_label_words(mapping, tokenizer, label_list)
+    model.label_word_list = torch.tensor(label_word_list).long()
+    if output_modes_mapping[task_name] == 'regression':
+        # lower / upper bounds
+        model.lb, model.ub = bound_mapping[task_name]
+    model.eval()
+    return model, tokenizer, label_list
+
+
+def example_inputs(tokenizer, batch_size, max_length, use_token_type_ids, device, seed=0):
+    """
+    Random (right padded) inputs with a mask token, in the layout of the dataset features.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(3, max_length + 1, (batch_size,), generator=generator)
+    lengths[0] = max_length
+    special_ids = set(tokenizer.all_special_ids)
+    regular_ids = torch.tensor([i for i in range(len(tokenizer)) if i not in special_ids])
+    if len(regular_ids) == 0:
+        raise ValueError("The tokenizer has no regular (non-special) tokens to build example inputs from")
+    input_ids = regular_ids[torch.randint(len(regular_ids), (batch_size, max_length), generator=generator)]
+    attention_mask = (torch.arange(max_length).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    input_ids[attention_mask == 0] = tokenizer.pad_token_id
+    input_ids[:, 0] = tokenizer.cls_token_id
+    mask_pos = torch.stack([torch.randint(1, int(length), (1,), generator=generator) for length in lengths])
+    input_ids[torch.arange(batch_size), mask_pos.squeeze(1)] = tokenizer.mask_token_id
+
+    inputs = [input_ids.to(device), attention_mask.to(device), mask_pos.to(device)]
+    if use_token_type_ids:
+        inputs.append(torch.zeros_like(input_ids).to(device))
+    return tuple(inputs)
+
+
+def input_names(use_token_type_ids):
+    return ['input_ids', 'attention_mask', 'mask_pos'] + (['token_type_ids'] if use_token_type_ids else [])
+
+
+def export_torchscript(wrapper, inputs, output_file):
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, inputs)
+    traced.save(output_file)
+
+
+def export_onnx(wrapper, inputs, output_file, opset_version=11):
+    names = input_names(wrapper.use_token_type_ids)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in names}
+    dynamic_axes['mask_pos'] = {0: 'batch'}
+    dynamic_axes['logits'] = {0: 'batch'}
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            inputs,
+            output_file,
+            input_names=names,
+            output_names=['logits'],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+
+
+def check_parity(wrapper, output_file, export_format, inputs_list, atol):
+    """
+    Compare the exported graph with the eager model on each of inputs_list. Returns the maximum absolute difference.
+    """
+    if export_format == 'torchscript':
+        exported = torch.jit.load(output_file, map_location=inputs_list[0][0].device)
+        run = lambda inputs: exported(*inputs)
+    else:
+        try:
+            import onnxruntime
+        except ImportError:
+            logger.warning("onnxruntime is not installed, skip the parity check")
+            return None
+        session = onnxruntime.InferenceSession(output_file)
+        names = input_names(wrapper.use_token_type_ids)
+        run = lambda inputs: torch.tensor(session.run(None, {name: t.cpu().numpy() for name, t in zip(names, inputs)})[0])
+
+    max_diff = 0.0
+    with torch.no_grad():
+        for inputs in inputs_list:
+            expected = wrapper(*inputs).cpu()
+            actual = run(inputs).cpu()
+            assert expected.shape == actual.shape, "Output shape mismatch: {} vs {}".format(expected.shape, actual.shape)
+            max_diff = max(max_diff, (expected - actual).abs().max().item())
+    if max_diff > atol:
+        raise ValueError("Exported model differs from the eager model: max abs diff {} > {}".format(max_diff, atol))
+    return max_diff
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, required=True, help="Checkpoint saved by run.py")
+    parser.add_argument('--task_name', type=str, required=True, help="Task name (e.g., sst-2), for the labels and the regression bounds")
+    parser.add_argument('--mapping', type=str, required=True, help="Label word mapping used in training")
+    parser.add_argument('--tokenizer_name', type=str, default=None, help="Tokenizer name or path if not the same as model_dir")
+    parser.add_argument('--output_file', type=str, required=True, help="Exported graph (a .pt file for TorchScript, a .onnx file for ONNX)")
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'], help="Export format")
+    parser.add_argument('--max_seq_length', type=int, default=128, help="Sequence length of the example inputs used for tracing")
+    parser.add_argument('--opset_version', type=int, default=11, help="ONNX opset version")
+    parser.add_argument('--atol', type=float, default=1e-4, help="Tolerance of the parity check")
+    parser.add_argument('--device', type=str, default='cpu', help="Device to trace on (the graph runs on this device)")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    model, tokenizer, label_list = load_prompt_model(
+        args.model_dir, args.task_name, args.mapping, args.tokenizer_name, torchscript=(args.format == 'torchscript')
+    )
+    model = model.to(args.device)
+    model.label_word_list = model.label_word_list.to(args.device)
+    wrapper = PromptModelForExport(model).eval()
+
+    inputs = example_inputs(tokenizer, 2, args.max_seq_length, wrapper.use_token_type_ids, args.device)
+    if args.format == 'torchscript':
+        export_torchscript(wrapper, inputs, args.output_file)
+    else:
+        export_onnx(wrapper, inputs, args.output_file, opset_version=args.opset_version)
+    logger.info("Exported to {}".format(args.output_file))
+
+    # Check on other batch sizes / lengths than the traced ones
+    parity_inputs = [
+        example_inputs(tokenizer, batch_size, max_length, wrapper.use_token_type_ids, args.device, seed=seed)
+        for seed, (batch_size, max_length) in enumerate([(2, args.max_seq_length), (1, args.max_seq_length // 2), (5, args.max_seq_length)])
+    ]
+    max_diff = check_parity(wrapper, args.output_file, args.format, parity_inputs, args.atol)
+    if max_diff is not None:
+        logger.info("Parity check passed (max abs diff {})".format(max_diff))
+
+    # What a scorer needs to prepare the inputs and read the outputs
+    with open(args.output_file + '.json', 'w') as f:
+        json.dump({
+            'task_name': args.task_name,
+            'format': args.format,
+            'inputs': input_names(wrapper.use_token_type_ids),
+            'labels': label_list,
+            'label_word_list': model.label_word_list.tolist(),
+            'regression': output_modes_mapping[args.task_name] == 'regression',
+            'bounds': [model.lb, model.ub],
+        }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
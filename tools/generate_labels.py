@@ -84,6 +84,11 @@ class DynamicDataTrainingArguments(DataTrainingArguments):
         metadata={"help": "When exceeding the maximum length, truncate the head instead of the tail."}
     )
 
+    dynamic_padding: bool = field(
+        default=False,
+        metadata={"help": "Do not pad features to max_seq_length. Keep it off here: this script batches with the default collator"}
+    )
+
     use_space_word: bool = field(
         default=True,
         metadata={"help": "Use space words (e.g., Gpositive) instead of original words."}
@@ -1,16 +1,25 @@
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
 import transformers
 from transformers import T5ForConditionalGeneration, T5Tokenizer
 import argparse
 import torch
-import os
 from tqdm import tqdm
 import json
 import argparse
 import pandas as pd
 
+from src.token_cache import get_token_cache
+from src.device import default_device, configure_cpu_threads
+
 def get_text(template, input_text_tuple, label, tokenizer, mapping):
     def enc(text):
         return tokenizer.encode(text, add_special_tokens=False)
+    # Sentences (and label words) go through the token cache, as they are shared by all the templates
+    token_cache = get_token_cache(tokenizer)
     special_token_mapping = {'cls': tokenizer.cls_token_id, 'mask': tokenizer.mask_token_id, 'sep': tokenizer.sep_token_id, 'sep+': tokenizer.sep_token_id}
     for i in range(10):
         special_token_mapping["<extra_id_%d>" % (i)] = tokenizer._convert_token_to_id("<extra_id_%d>" % (i))
@@ -24,47 +33,37 @@ def get_text(template, input_text_tuple, label, tokenizer, mapping):
                 continue
             new_tokens.append(special_token_mapping[part])
         elif part[:5] == 'label':
-            new_tokens += enc(' ' + mapping[label])
+            new_tokens += token_cache.encode(mapping[label], '+')
         elif part[:5] == 'sent_':
             sent_id = int(part.split('_')[1])
-            new_tokens += enc(input_text_tuple[sent_id])
+            new_tokens += token_cache.encode(input_text_tuple[sent_id])
         elif part[:6] == '+sent_':
             sent_id = int(part.split('_')[1])
-            new_tokens += enc(' ' + input_text_tuple[sent_id]) # add space
+            new_tokens += token_cache.encode(input_text_tuple[sent_id], '+') # add space
         elif part[:6] == 'sent-_':
             # Delete the last token
             sent_id = int(part.split('_')[1])
-            new_tokens += enc(input_text_tuple[sent_id][:-1])
+            new_tokens += token_cache.encode(input_text_tuple[sent_id], '-')
         elif part[:7] == '+sentl_':
             # Lower case the first token
             sent_id = int(part.split('_')[1])
-            text = input_text_tuple[sent_id]
-            text = text[:1].lower() + text[1:]
-            new_tokens += enc(' ' + text)
+            new_tokens += token_cache.encode(input_text_tuple[sent_id], '+l')
         elif part[:7] == '+sentu_':
             # Upper case the first token
             sent_id = int(part.split('_')[1])
-            text = input_text_tuple[sent_id]
-            text = text[:1].upper() + text[1:]
-            new_tokens += enc(' ' + text)
+            new_tokens += token_cache.encode(input_text_tuple[sent_id], '+u')
         elif part[:6] == 'sentl_':
             # Lower case the first token
             sent_id = int(part.split('_')[1])
-            text = input_text_tuple[sent_id]
-            text = text[:1].lower() + text[1:]
-            new_tokens += enc(text)
+            new_tokens += token_cache.encode(input_text_tuple[sent_id], 'l')
         elif part[:6] == 'sentu_':
             # Lower case the first token
             sent_id = int(part.split('_')[1])
-            text = input_text_tuple[sent_id]
-            text = text[:1].upper() + text[1:]
-            new_tokens += enc(text)
+            new_tokens += token_cache.encode(input_text_tuple[sent_id], 'u')
         elif part[:7] == 'sentl-_':
             # Lower case the first token
             sent_id = int(part.split('_')[1])
-            text = input_text_tuple[sent_id]
-            text = text[:1].lower() + text[1:]
-            new_tokens += enc(text[:-1])
+            new_tokens += token_cache.encode(input_text_tuple[sent_id], 'l-')
         else:
             part = part.replace('_', ' ') # there cannot be space in command, so use '_' to replace space
             # handle special case when t5 tokenizer might add an extra space
@@ -116,8 +115,8 @@ def generate(dataset, template, model, tokenizer, target_number, mapping, beam,
     print(tokenizer.decode(input_ids[2]))
     print('####### example #######\n')
 
-    input_ids = input_ids.cuda()
-    attention_mask = attention_mask.cuda()
+    input_ids = input_ids.to(model.device)
+    attention_mask = attention_mask.to(model.device)
     assert len(input_tensors) > 0
 
     # Maximum generate content length
@@ -153,7 +152,7 @@ def generate(dataset, template, model, tokenizer, target_number, mapping, beam,
                 end = min((t + 1) * batch_size, input_ids.size(0))
 
                 with torch.no_grad():
-                    aggr_output.append(model(input_ids[start:end], attention_mask=attention_mask[start:end], decoder_input_ids=decoder_input_ids.cuda()[start:end])[0])
+                    aggr_output.append(model(input_ids[start:end], attention_mask=attention_mask[start:end], decoder_input_ids=decoder_input_ids.to(model.device)[start:end])[0])
             aggr_output = torch.cat(aggr_output, 0)
 
             # Gather results across all input sentences, and sort generated tokens by log likelihood
@@ -356,14 +355,19 @@ def main():
     parser.add_argument('--data_dir', type=str, default="data/k-shot", help="Data directory")
     parser.add_argument('--beam', type=int, default=100, help="Beam search width")
     parser.add_argument('--k', type=int, default=16, help="Number of training instances per label")
+    parser.add_argument('--device', type=str, default=None, help="Device to run on (default: cuda if available, else cpu)")
+    parser.add_argument('--intra_op_threads', type=int, default=0, help="Number of threads inside each op (0: PyTorch default)")
+    parser.add_argument('--inter_op_threads', type=int, default=0, help="Number of threads running independent ops (0: PyTorch default)")
+    parser.add_argument('--cpu_affinity', type=str, default=None, help="Pin the process to these CPU cores, e.g., 0-7,16-23")
  
     args = parser.parse_args()
+    configure_cpu_threads(args.intra_op_threads, args.inter_op_threads, args.cpu_affinity)
 
     model = T5ForConditionalGeneration.from_pretrained(args.t5_model)
     tokenizer = T5Tokenizer.from_pretrained(args.t5_model)
     tokenizer.sep_token = '</s>'
 
-    model = model.cuda()
+    model = model.to(args.device if args.device is not None else default_device())
     model.eval()
 
     for task_name in args.task_name:
@@ -1,10 +1,16 @@
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
 from sentence_transformers import SentenceTransformer, util
 import argparse
-import os
 import numpy as np
 from tqdm import tqdm
 import pandas as pd
 
+from src.device import default_device, configure_cpu_threads
+
 def get_sentence(task, line):
     if task in ['mr', 'sst-5', 'subj', 'trec', 'cr', 'mpqa']:
         # Text classification tasks
@@ -78,11 +84,15 @@ def main():
     parser.add_argument("--data_dir", type=str, default="data/k-shot", help="Path to few-shot data")
     parser.add_argument("--seed", type=int, nargs="+", default=[42, 13, 21, 87, 100], help="Seeds for data splits")
     parser.add_argument("--task", type=str, nargs="+", default=["SST-2", "sst-5", "mr", "cr", "mpqa", "subj", "trec", "CoLA", "MRPC", "QQP", "STS-B", "MNLI", "SNLI", "QNLI", "RTE"], help="Tasks")
+    parser.add_argument("--device", type=str, default=None, help="Device to run on (default: cuda if available, else cpu)")
+    parser.add_argument("--intra_op_threads", type=int, default=0, help="Number of threads inside each op (0: PyTorch default)")
+    parser.add_argument("--inter_op_threads", type=int, default=0, help="Number of threads running independent ops (0: PyTorch default)")
+    parser.add_argument("--cpu_affinity", type=str, default=None, help="Pin the process to these CPU cores, e.g., 0-7,16-23")
 
     args = parser.parse_args()
+    configure_cpu_threads(args.intra_op_threads, args.inter_op_threads, args.cpu_affinity)
 
-    model = SentenceTransformer('{}-nli-stsb-mean-tokens'.format(args.sbert_model))
-    model = model.cuda()
+    model = SentenceTransformer('{}-nli-stsb-mean-tokens'.format(args.sbert_model), device=str(args.device if args.device is not None else default_device()))
 
     for task in args.task:
         for seed in args.seed:
@@ -0,0 +1,284 @@
+"""Label a large unlabeled corpus with a prompt-based fine-tuned model (saved by run.py), streaming and resumable."""
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import csv
+import json
+import time
+import logging
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from transformers import HfArgumentParser
+
+from run import ModelArguments, DynamicDataTrainingArguments, load_prompt, auto_demo_template
+from src.serving import load_scorer, featurize_inputs, _init_featurize_worker, _featurize_inputs_in_worker
+from src.device import default_device, configure_cpu_threads
+from src.processors import num_labels_mapping
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PredictionArguments:
+    input_file: str = field(
+        metadata={"help": "Unlabeled inputs (.tsv, .csv or .jsonl)"}
+    )
+
+    output_dir: str = field(
+        metadata={"help": "Directory of the prediction shards (predictions-00000.jsonl, ...)"}
+    )
+
+    input_format: Optional[str] = field(
+        default=None,
+        metadata={"help": "tsv, csv or jsonl (default: from the extension of input_file)"}
+    )
+
+    text_a_column: str = field(
+        default='sentence',
+        metadata={"help": "Column (or JSON key) of the first sentence; a column index with no_header"}
+    )
+
+    text_b_column: Optional[str] = field(
+        default=None,
+        metadata={"help": "Column (or JSON key) of the second sentence, for sentence pair tasks"}
+    )
+
+    no_header: bool = field(
+        default=False,
+        metadata={"help": "The tsv/csv file has no header row"}
+    )
+
+    shard_size: int = field(
+        default=100000,
+        metadata={"help": "Number of inputs per output shard (the unit of resuming)"}
+    )
+
+    chunk_size: int = field(
+        default=1024,
+        metadata={"help": "Number of inputs featurized by a worker at once"}
+    )
+
+    prefetch_shards: int = field(
+        default=1,
+        metadata={"help": "Number of shards featurized ahead of the model"}
+    )
+
+    batch_size: int = field(
+        default=64,
+        metadata={"help": "Number of features per batch"}
+    )
+
+    num_sample: Optional[int] = field(
+        default=None,
+        metadata={"help": "Samples (demonstration samples x templates) averaged per input (default: as on the dev/test sets)"}
+    )
+
+    seed: int = field(
+        default=42,
+        metadata={"help": "Seed of the demonstration sampling (also selects the training data with data_dir)"}
+    )
+
+    device: Optional[str] = field(
+        default=None,
+        metadata={"help": "Device to run the model on (default: cuda if available)"}
+    )
+
+    intra_op_threads: int = field(
+        default=0,
+        metadata={"help": "Number of intra-op threads (0: torch default)"}
+    )
+
+    inter_op_threads: int = field(
+        default=0,
+        metadata={"help": "Number of inter-op threads (0: torch default)"}
+    )
+
+    cpu_affinity: Optional[str] = field(
+        default=None,
+        metadata={"help": "Pin the process to these CPUs (e.g., 0-7,16-23)"}
+    )
+
+
+def read_inputs(args):
+    """
+    Stream (text_a, text_b) pairs from the input file.
+    """
+    input_format = args.input_format
+    if input_format is None:
+        input_format = os.path.splitext(args.input_file)[1].lstrip('.').lower()
+
+    with open(args.input_file, encoding='utf-8') as f:
+        if input_format == 'jsonl':
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record[args.text_a_column], record[args.text_b_column] if args.text_b_column is not None else None
+        elif input_format in ['tsv', 'csv']:
+            if input_format == 'tsv':
+                reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+            else:
+                reader = csv.reader(f)
+            if args.no_header:
+                a, b = int(args.text_a_column), int(args.text_b_column) if args.text_b_column is not None else None
+            else:
+                header = next(reader)
+                a, b = header.index(args.text_a_column), header.index(args.text_b_column) if args.text_b_column is not None else None
+            num_columns = max(a, b if b is not None else -1) + 1
+            for row in reader:
+                if len(row) < num_columns:
+                    raise ValueError("{}, line {}: expected at least {} columns, got {}".format(
+                        args.input_file, reader.line_num, num_columns, len(row)))
+                yield row[a], row[b] if b is not None else None
+        else:
+            raise ValueError("Unknown input format: {}".format(input_format))
+
+
+def shard_file(output_dir, shard_idx):
+    return os.path.join(output_dir, "predictions-{:05d}.jsonl".format(shard_idx))
+
+
+def check_run_config(args, model_args, data_args, num_sample):
+    """
+    Record the settings that determine the shards (input, model, prompt), or check that a resumed run uses the same
+    ones.
+    """
+    stat = os.stat(args.input_file)
+    config = {
+        'input_file': os.path.abspath(args.input_file),
+        'input_size': stat.st_size,
+        'input_format': args.input_format,
+        'text_a_column': args.text_a_column,
+        'text_b_column': args.text_b_column,
+        'no_header': args.no_header,
+        'model_name_or_path': os.path.abspath(model_args.model_name_or_path) if os.path.exists(model_args.model_name_or_path) else model_args.model_name_or_path,
+        'few_shot_type': model_args.few_shot_type,
+        'data_dir': os.path.abspath(data_args.data_dir),
+        'template': data_args.template,
+        'template_list': data_args.template_list,
+        'mapping': data_args.mapping,
+        'shard_size': args.shard_size,
+        'num_sample': num_sample,
+        'seed': args.seed,
+    }
+    config_file = os.path.join(args.output_dir, "config.json")
+    if os.path.exists(config_file):
+        with open(config_file) as f:
+            previous = json.load(f)
+        if previous != config:
+            raise ValueError("{} was written with other settings ({}), use another output_dir".format(args.output_dir, previous))
+    else:
+        with open(config_file, 'w') as f:
+            json.dump(config, f, indent=2)
+
+
+def completed_shards(output_dir):
+    """
+    Number of shards completed by a previous run. Shards are renamed into place once fully written, so they are
+    either complete or missing.
+    """
+    num_shards = 0
+    while os.path.exists(shard_file(output_dir, num_shards)):
+        num_shards += 1
+    return num_shards
+
+
+def write_shard(output_dir, shard_idx, first_index, predictions):
+    path = shard_file(output_dir, shard_idx)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        for i, prediction in enumerate(predictions):
+            f.write(json.dumps(dict(index=first_index + i, **prediction)) + "\n")
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, PredictionArguments))
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, data_args, args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, data_args, args = parser.parse_args_into_dataclasses()
+    logging.basicConfig(level=logging.INFO)
+
+    configure_cpu_threads(args.intra_op_threads, args.inter_op_threads, args.cpu_affinity)
+
+    # Same template / mapping as in training
+    if 'prompt' in model_args.few_shot_type:
+        data_args.prompt = True
+    load_prompt(data_args)
+    auto_demo_template(model_args, data_args, num_labels_mapping[data_args.task_name])
+    # Features are padded per batch
+    data_args.dynamic_padding = True
+
+    device = args.device if args.device is not None else default_device()
+    scorer = load_scorer(model_args, data_args, device, seed=args.seed)
+    num_sample = args.num_sample if args.num_sample is not None else scorer.num_sample
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    check_run_config(args, model_args, data_args, num_sample)
+    start_shard = completed_shards(args.output_dir)
+    if start_shard > 0:
+        logger.info("Resume from shard %d (%d inputs done)" % (start_shard, start_shard * args.shard_size))
+
+    # Featurization runs in the background (worker processes, or one thread), prefetch_shards shards ahead
+    if data_args.featurize_workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=data_args.featurize_workers,
+            initializer=_init_featurize_worker,
+            initargs=(scorer.dataset,),
+        )
+        submit = lambda chunk: executor.submit(_featurize_inputs_in_worker, chunk, num_sample, args.seed)
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+        submit = lambda chunk: executor.submit(featurize_inputs, scorer.dataset, chunk, num_sample, args.seed)
+
+    inputs = read_inputs(args)
+    # Skip the inputs of the completed shards (read, but not featurized)
+    inputs = itertools.islice(inputs, start_shard * args.shard_size, None)
+
+    def submit_shard():
+        inputs_of_shard = list(itertools.islice(inputs, args.shard_size))
+        if len(inputs_of_shard) == 0:
+            return None
+        return [submit(inputs_of_shard[i:i + args.chunk_size]) for i in range(0, len(inputs_of_shard), args.chunk_size)]
+
+    pending = []
+    for _ in range(args.prefetch_shards + 1):
+        futures = submit_shard()
+        if futures is None:
+            break
+        pending.append(futures)
+
+    shard_idx = start_shard
+    while len(pending) > 0:
+        start_time = time.time()
+        per_input = [features for future in pending.pop(0) for features in future.result()]
+        # Keep the workers busy while the model runs
+        futures = submit_shard()
+        if futures is not None:
+            pending.append(futures)
+
+        features = [f for samples in per_input for f in samples]
+        logits = scorer.score_bucketed(features, args.batch_size)
+        predictions = []
+        offset = 0
+        for samples in per_input:
+            predictions.append(scorer.aggregate(logits[offset:offset + len(samples)]))
+            offset += len(samples)
+
+        write_shard(args.output_dir, shard_idx, shard_idx * args.shard_size, predictions)
+        elapsed = time.time() - start_time
+        logger.info("Shard %d: %d inputs, %d features, %.1f inputs/sec" % (shard_idx, len(per_input), len(features), len(per_input) / max(elapsed, 1e-6)))
+        shard_idx += 1
+
+    executor.shutdown()
+    logger.info("Done: %d shards in %s" % (shard_idx, args.output_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Serve a prompt-based fine-tuned model (saved by run.py) over HTTP, with micro-batching of concurrent requests."""
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import json
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from transformers import HfArgumentParser
+
+from run import ModelArguments, DynamicDataTrainingArguments, load_prompt, auto_demo_template
+from src.serving import load_scorer, MicroBatcher
+from src.device import default_device, configure_cpu_threads
+from src.processors import num_labels_mapping
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ServingArguments:
+    host: str = field(
+        default='127.0.0.1',
+        metadata={"help": "Host to listen on"}
+    )
+
+    port: int = field(
+        default=8000,
+        metadata={"help": "Port to listen on"}
+    )
+
+    unix_socket: Optional[str] = field(
+        default=None,
+        metadata={"help": "Listen on this Unix socket instead of host:port"}
+    )
+
+    max_batch_size: int = field(
+        default=32,
+        metadata={"help": "Maximum number of features (input samples) in a micro-batch"}
+    )
+
+    max_latency_ms: float = field(
+        default=10.0,
+        metadata={"help": "Maximum time (ms) a feature waits for its micro-batch to fill up"}
+    )
+
+    seed: int = field(
+        default=42,
+        metadata={"help": "Seed of the demonstration sampling (also selects the training data with data_dir)"}
+    )
+
+    device: Optional[str] = field(
+        default=None,
+        metadata={"help": "Device to run the model on (default: cuda if available)"}
+    )
+
+    intra_op_threads: int = field(
+        default=0,
+        metadata={"help": "Number of intra-op threads (0: torch default)"}
+    )
+
+    inter_op_threads: int = field(
+        default=0,
+        metadata={"help": "Number of inter-op threads (0: torch default)"}
+    )
+
+    cpu_affinity: Optional[str] = field(
+        default=None,
+        metadata={"help": "Pin the process to these CPUs (e.g., 0-7,16-23)"}
+    )
+
+
+class PredictionServer:
+    """
+    A minimal HTTP/1.1 server (one request per connection) with the endpoints
+        POST /predict  {"text_a": ..., "text_b": ..., "num_sample": ...} or {"inputs": [{...}, ...]}
+        GET  /metrics  queue depth, batch sizes and latency of the micro-batcher
+        GET  /health
+    """
+
+    def __init__(self, scorer, batcher):
+        self.scorer = scorer
+        self.batcher = batcher
+        # Featurization (tokenization, demonstration sampling) runs off the event loop, next to the model thread
+        self.featurize_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def predict(self, request):
+        num_sample = request.get('num_sample')
+        featurize = functools.partial(self.scorer.featurize, request['text_a'], request.get('text_b'), num_sample=num_sample)
+        features = await asyncio.get_event_loop().run_in_executor(self.featurize_executor, featurize)
+        logits = await self.batcher.submit(features)
+        return self.scorer.aggregate(logits)
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/metrics':
+            return 200, self.batcher.metrics()
+        if method == 'POST' and path == '/predict':
+            request = json.loads(body.decode('utf-8'))
+            if 'inputs' in request:
+                return 200, {'predictions': await asyncio.gather(*[self.predict(r) for r in request['inputs']])}
+            return 200, await self.predict(request)
+        return 404, {'error': 'Not found: {} {}'.format(method, path)}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            if not request_line:
+                return
+            method, path = request_line.split(' ')[:2]
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            try:
+                status, response = await self.route(method, path, body)
+            except (ValueError, KeyError, TypeError) as e:
+                status, response = 400, {'error': repr(e)}
+            except Exception as e:
+                logger.exception("Request failed")
+                status, response = 500, {'error': repr(e)}
+
+            payload = json.dumps(response).encode('utf-8')
+            reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status, reason, len(payload)).encode('latin-1') + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+def serve(server, serving_args):
+    """
+    Run the server until interrupted.
+    """
+    loop = asyncio.get_event_loop()
+    asyncio.ensure_future(server.batcher.run())
+    if serving_args.unix_socket is not None:
+        listener = loop.run_until_complete(asyncio.start_unix_server(server.handle, path=serving_args.unix_socket))
+        logger.info("Serving on {}".format(serving_args.unix_socket))
+    else:
+        listener = loop.run_until_complete(asyncio.start_server(server.handle, serving_args.host, serving_args.port))
+        logger.info("Serving on http://{}:{}".format(serving_args.host, serving_args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+
+
+def main():
+    parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, ServingArguments))
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, data_args, serving_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, data_args, serving_args = parser.parse_args_into_dataclasses()
+    logging.basicConfig(level=logging.INFO)
+
+    configure_cpu_threads(serving_args.intra_op_threads, serving_args.inter_op_threads, serving_args.cpu_affinity)
+
+    # Same template / mapping as in training
+    if 'prompt' in model_args.few_shot_type:
+        data_args.prompt = True
+    load_prompt(data_args)
+    auto_demo_template(model_args, data_args, num_labels_mapping[data_args.task_name])
+    # Features of new inputs are built one by one, so they are never padded to max_seq_length
+    data_args.dynamic_padding = True
+
+    device = serving_args.device if serving_args.device is not None else default_device()
+    scorer = load_scorer(model_args, data_args, device, seed=serving_args.seed)
+    batcher = MicroBatcher(scorer, max_batch_size=serving_args.max_batch_size, max_latency=serving_args.max_latency_ms / 1000)
+    serve(PredictionServer(scorer, batcher), serving_args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Run the trials of a sweep (a grid of run.py arguments), sharing what the trials have in common. With --num_workers,
+several trials run concurrently (one process each, with its own CPU threads). With --max_replicas, the trials that
+only differ by their seed and data split are trained together, as replicas (see src/replicas.py).
+"""
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import gc
+import time
+import shutil
+import argparse
+import dataclasses
+import logging
+import multiprocessing
+import torch
+from concurrent.futures import ProcessPoolExecutor
+
+from transformers import HfArgumentParser
+
+from run import ModelArguments, DynamicDataTrainingArguments, DynamicTrainingArguments, run, run_replicas
+from src.sweep import TrialResources, expand_grid, load_sweep_spec, trial_key, completed_trial_keys, merge_log_shards, replica_groups
+from src.device import configure_cpu_threads
+from src.replicas import vmap_available
+
+logger = logging.getLogger(__name__)
+
+ARGUMENT_CLASSES = (ModelArguments, DynamicDataTrainingArguments, DynamicTrainingArguments)
+
+
+def trial_arguments(trial):
+    """
+    (model_args, data_args, training_args) of a trial (a dict of run.py arguments).
+    """
+    known = {f.name for cls in ARGUMENT_CLASSES for f in dataclasses.fields(cls)}
+    unknown = sorted(set(trial.keys()) - known)
+    if len(unknown) > 0:
+        raise ValueError("Unknown arguments in the sweep spec: {}".format(unknown))
+    return HfArgumentParser(ARGUMENT_CLASSES).parse_dict(trial)
+
+
+def run_trial(trial, resources, keep_checkpoints=False, log_file='log'):
+    """
+    Run one trial and remove its output_dir afterwards (as run_experiment.sh does) unless keep_checkpoints.
+    Returns whether it succeeded.
+    """
+    return run_group([trial], resources, keep_checkpoints=keep_checkpoints, log_file=log_file) == 0
+
+
+def run_group(trials, resources, keep_checkpoints=False, log_file='log'):
+    """
+    Run a group of trials (from `replica_groups`): one trial as `run_trial`, several as replicas trained together.
+    Returns the number of failed trials.
+    """
+    arguments = [trial_arguments(trial) for trial in trials]
+    extra_results = [{'sweep_trial_key': trial_key(trial)} for trial in trials]
+    start = time.time()
+    try:
+        if len(trials) == 1:
+            run(*arguments[0], resources=resources, log_file=log_file, extra_result=extra_results[0])
+        else:
+            run_replicas(arguments, resources=resources, log_files=[log_file] * len(trials), extra_results=extra_results)
+        num_failed = 0
+    except Exception:
+        logger.exception("Trial failed: {}".format(trials[0] if len(trials) == 1 else trials))
+        num_failed = len(trials)
+    finally:
+        for _, _, training_args in arguments:
+            if not keep_checkpoints and os.path.isdir(training_args.output_dir):
+                shutil.rmtree(training_args.output_dir, ignore_errors=True)
+        # Release the model of the trial before the next one
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    logger.info("%s finished in %.1fs" % ("Trial" if len(trials) == 1 else "%d replicas" % len(trials), time.time() - start))
+    return num_failed
+
+
+# State of a worker process (concurrent trials)
+_worker = {}
+
+
+def available_cores():
+    """
+    The CPU cores this process may run on (its affinity mask, which may be a subset of the machine's cores).
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _init_worker(worker_ids, threads_per_worker, worker_cores, checkpoints, log_file):
+    """
+    Take a worker id, limit the CPU threads (and cores, with worker_cores: the cores of each worker) of the worker,
+    and set up its resources.
+    Results go to a log shard of the worker, so that workers do not wait for each other on the log lock.
+    """
+    worker_id = worker_ids.get()
+    cpu_affinity = None
+    if worker_cores is not None:
+        cpu_affinity = ",".join(str(core) for core in worker_cores[worker_id])
+    configure_cpu_threads(intra_op_threads=threads_per_worker, inter_op_threads=1, cpu_affinity=cpu_affinity)
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - worker {} - %(name)s -   %(message)s".format(worker_id),
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    _worker['resources'] = TrialResources(share=True)
+    # Pretrained weights loaded by the scheduler, in shared memory
+    _worker['resources'].checkpoints.update(checkpoints)
+    _worker['log_file'] = "{}.shard-{}".format(log_file, worker_id)
+
+
+def _run_group_in_worker(trials, keep_checkpoints):
+    return run_group(trials, _worker['resources'], keep_checkpoints=keep_checkpoints, log_file=_worker['log_file'])
+
+
+def run_concurrent(groups, num_workers, threads_per_worker, worker_cores, keep_checkpoints, log_file):
+    """
+    Run groups of trials in a pool of num_workers processes, fed from a queue in the order of the sweep.
+    """
+    trials = [trial for group in groups for trial in group]
+    output_dirs = [trial_arguments(trial)[2].output_dir for trial in trials]
+    if len(set(output_dirs)) < len(output_dirs):
+        raise ValueError("Trials that run concurrently need different output_dir, e.g., \"output_dir\": \"result/{task_name}-{seed}-{learning_rate}\"")
+
+    # Read the pretrained weights once, for all the workers
+    resources = TrialResources(share=True)
+    for model_args in [trial_arguments(trial)[0] for trial in trials]:
+        if ".ckpt" not in model_args.model_name_or_path:
+            resources.pretrained_state_dict(model_args.model_name_or_path, cache_dir=model_args.cache_dir)
+
+    worker_ids = multiprocessing.Manager().Queue()
+    for worker_id in range(num_workers):
+        worker_ids.put(worker_id)
+    num_failed = 0
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_worker,
+        initargs=(worker_ids, threads_per_worker, worker_cores, resources.checkpoints, log_file),
+    ) as executor:
+        futures = [executor.submit(_run_group_in_worker, group, keep_checkpoints) for group in groups]
+        num_done = 0
+        for group, future in zip(groups, futures):
+            num_failed += future.result()
+            num_done += len(group)
+            logger.info("{}/{} trials done".format(num_done, len(trials)))
+    return num_failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spec', type=str, required=True, help="Sweep spec (json): {\"base\": {run.py arguments}, \"grid\": {argument: [values]}}")
+    parser.add_argument('--keep_checkpoints', action="store_true", help="Keep the output_dir of every trial")
+    parser.add_argument('--log', type=str, default='log', help="Log to append the results to, and to find the trials that are done")
+    parser.add_argument('--rerun', action="store_true", help="Also run the trials that are already in the log")
+    parser.add_argument('--num_workers', type=int, default=1, help="Number of trials that run concurrently (1: in this process)")
+    parser.add_argument('--threads_per_worker', type=int, default=0, help="CPU threads of each worker (0: the cores divided by num_workers)")
+    parser.add_argument('--pin_workers', action="store_true", help="Pin each worker to its own threads_per_worker cores")
+    parser.add_argument('--max_replicas', type=int, default=1, help="Train up to this many trials that only differ by their seed and data split together, as replicas (1: one by one)")
+    args = parser.parse_args()
+    if args.max_replicas > 1 and not vmap_available():
+        parser.error("--max_replicas needs torch.func (torch >= 2.0), found torch {}".format(torch.__version__))
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    trials = expand_grid(load_sweep_spec(args.spec))
+    # Check all the trials before running any
+    for trial in trials:
+        trial_arguments(trial)
+
+    # Results of workers of an interrupted sweep
+    merge_log_shards(args.log)
+    if not args.rerun:
+        done = completed_trial_keys(args.log)
+        logger.info("Skip {} trials that are already in {}".format(sum(trial_key(trial) in done for trial in trials), args.log))
+        trials = [trial for trial in trials if trial_key(trial) not in done]
+    groups = replica_groups(trials, max(args.max_replicas, 1))
+    logger.info("Sweep of {} trials ({} groups)".format(len(trials), len(groups)))
+
+    if args.num_workers > 1:
+        cores = available_cores()
+        threads_per_worker = args.threads_per_worker if args.threads_per_worker > 0 else max(len(cores) // args.num_workers, 1)
+        logger.info("{} workers with {} threads each".format(args.num_workers, threads_per_worker))
+        worker_cores = None
+        if args.pin_workers:
+            if not hasattr(os, "sched_setaffinity"):
+                parser.error("--pin_workers is not supported on this platform")
+            if args.num_workers * threads_per_worker > len(cores):
+                parser.error("--pin_workers needs num_workers x threads_per_worker = {} cores, but only {} are available ({})".format(
+                    args.num_workers * threads_per_worker, len(cores), ",".join(str(core) for core in cores)))
+            # Disjoint slices of the cores the sweep may use
+            worker_cores = [cores[i * threads_per_worker:(i + 1) * threads_per_worker] for i in range(args.num_workers)]
+        try:
+            num_failed = run_concurrent(groups, args.num_workers, threads_per_worker, worker_cores, args.keep_checkpoints, args.log)
+        finally:
+            merge_log_shards(args.log)
+    else:
+        # The CPU threads are set once for the process: the ones of the first trial
+        thread_args = {(a.intra_op_threads, a.inter_op_threads, a.cpu_affinity) for a in [trial_arguments(trial)[2] for trial in trials]}
+        if len(thread_args) > 1:
+            logger.warning("Trials set different CPU threads, use the ones of the first trial for the whole sweep")
+        if len(trials) > 0:
+            training_args = trial_arguments(trials[0])[2]
+            configure_cpu_threads(training_args.intra_op_threads, training_args.inter_op_threads, training_args.cpu_affinity)
+
+        resources = TrialResources(share=True)
+        num_failed = 0
+        for i, group in enumerate(groups):
+            logger.info("***** Trial group {}/{} ({} trials) *****".format(i + 1, len(groups), len(group)))
+            num_failed += run_group(group, resources, keep_checkpoints=args.keep_checkpoints, log_file=args.log)
+    logger.info("Sweep done: {} trials, {} failed".format(len(trials), num_failed))
+
+
+if __name__ == '__main__':
+    main()